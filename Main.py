@@ -1,23 +1,26 @@
-import time
 import tkinter
 
-import comtypes.client as cc
 from tkinter import *
 import tkinter as tk
 from tkinter import font as tkfont
 from tkinter import ttk
 import logging
+import math
 import os
+import queue
 import configparser
 from threading import Thread
 import sys
-import serial.tools.list_ports
-import socket
 from logging.handlers import TimedRotatingFileHandler
+import engine
+import logqueue
+import results
+import topology
+import tracing
 
 
 # Setup Logging
-errors = []
+errors = engine.errors
 print('Setting up Logging')
 def resource_path(relative_path: str) -> str:
     """ Get absolute path to resource, works for dev and PyInstaller """
@@ -34,12 +37,22 @@ os.makedirs(log_dir, exist_ok=True)
 
 log_path: str = os.path.join(log_dir, 'LaserHypotCont.log')
 
+# Fixture Topology, --config=<file> picks another fixture's description when several run on this PC
+topologyPath = next((arg.split('=', 1)[1] for arg in sys.argv if arg.startswith('--config=')), resource_path(topology.topologyPath))
+fixtureTopology = topology.load_topology(topologyPath)
+engine.apply_topology(fixtureTopology)
+settingsPath = fixtureTopology['settings']
+
 # Setup logger
 logger = logging.getLogger('Rotating Log')
 handler = TimedRotatingFileHandler(filename=log_path,when='h',interval=8,backupCount=30)
-handler.setFormatter(logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s'))
 handler.suffix = "%Y-%m-%d_%H-%M-%S.log"
-logger.addHandler(handler)
+loggingConfig = configparser.ConfigParser()  # Read ahead of the other settings, logging has to be up first
+loggingConfig.read(settingsPath)
+queuedLogging = loggingConfig.getboolean('Logging', 'queued', fallback=True)  # File writes and poll echo happen on a listener thread
+spanLogging = loggingConfig.getboolean('Logging', 'spans', fallback=False)  # Every phase of every cavity to spans.csv, grows fast
+logListener = logqueue.setup_logging(logger, handler, queued=queuedLogging)
+engine.printPolls = logListener is None  # The listener echoes hypot polls to the console itself
 logger.setLevel(logging.DEBUG)
 
 
@@ -52,56 +65,26 @@ config['Admin'] = {}
 config['Hypot'] = {}
 config['Laser'] = {}
 config['Hardware IDs'] = {}
+config['Logging'] = {'queued': str(int(queuedLogging)), 'spans': str(int(spanLogging))}
 
 
 print('Setting up Drivers')
 # Driver Variables
-cc.GetModule('SC6540.dll')
-from comtypes.gen import SC6540Lib
-
-cc.GetModule('ARI38XX_64.dll')
-from comtypes.gen import ARI38XXLib
+# Simulated instruments run the whole program without the Windows drivers or the fixture, for tuning cycle time
+simulateInstruments = '--simulate' in sys.argv or os.environ.get('LHC_SIMULATE') == '1'
 
-hypotHwid1 = "AQ0465JUA"
-hypotHwid2 = "A107A3OCA"
-switchHwid1 = "B0007EEKA"
-switchHwid2 = "B0007BEKA"
+defaultHwids = {'hypot1': "AQ0465JUA", 'hypot2': "A107A3OCA", 'switch1': "B0007EEKA", 'switch2': "B0007BEKA"}  # Stock fixture
+instrumentHwids = {name: defaultHwids.get(name, '') for name in engine.driverLabels}
 
 
-# Setup Laser Connectivity
-laserSocket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)  # Creates socket
-laserIP = '10.10.0.167'
-try:
-    laserSocket.connect((laserIP, 50000))  # IP and Port number for laser
-except Exception as e:
-    print(f'Connection to Laser Marker failed: {e}')
-    logger.error(f'Connection to Laser Marker failed: {e}')
-    errors.append(f'Connection to Laser Marker failed')
-
 # General Variables
 adminPassword = '6789'  # Default password if not set in the settings file
-faultState = False
-cavityContinuitySuccesses = {} # 0=Failure, 1=Success, 2=SkippedIfContFail
-cavityHypotSuccesses = {}
-runCavity = {}
+laserConfirmed = engine.laserConfirmed
+runCavity = {}  # 'cavityN': IntVar of the admin checkboxes, the engine's batch state gets a copy
 laserEnabled = {}
-hypotSettings = {}
+hypotSettings = engine.hypotSettings
 usbHwids = set()
-defaultHypotSettings = {
-    'voltage': 1000,  # AC Voltage
-    'currenthighlimit': 10,  # Current High Limit
-    'currentlowlimit': 0.001,  # Current Low Limit
-    'rampuptime': 0.1,  # Ramp up time in seconds
-    'dwelltime': 0.3,  # RampDownTime in seconds
-    'rampdowntime': 0.0,  # Dewll time in seconds
-    'arcsenselevel': 1,  # ArcSense level
-    'arcdetection': False,  # Arc detection
-    'frequency': ARI38XXLib.ARI38XXFrequency60Hz,  # Frequency
-    'continuitytest': True,  # Continuity test
-    'highlimitresistance': 1.5,  # High limit of the continuity resistance
-    'lowlimitresistance': 0.01,  # Low limit of the continuity resistance
-    'resistanceoffset': 0.5  # Continuity resistance offset
-}
+defaultHypotSettings = engine.default_hypot_settings()
 
 # Admin Panel Settings Variables
 hypotTkinterObjs = {}
@@ -109,6 +92,9 @@ hypotTkinterObjsLabel = {}
 hypotArcDetectionBool = None
 
 # UI Variables
+uiEventInterval = 50  # ms between drains of the engine's UI events
+resetDebounce = 1000  # ms START stays disabled after a reset so double clicks dont accidentally start it again
+resetAfterId = None
 rectangles = {}
 statusText = {}
 root = tk.Tk()
@@ -120,6 +106,7 @@ canvasColor = '#3D434B'
 enabledColor = '#26A671'
 halfDisabledColor = '#F9A825'
 disabledColor = '#DE0A02'
+runningColor = '#1E6FD9'
 textBackgroundColor = '#2A2E32'
 textColor = 'White'
 
@@ -128,112 +115,52 @@ root.configure(bg=backgroundColor)
 
 
 def get_usb_hwids():
-    ports = serial.tools.list_ports.comports()
-    for port in ports:
-        hwid = port.hwid.split('SER=')[1]
-        usbHwids.add(hwid)
+    usbHwids.clear()
+    usbHwids.update(engine.usb_hwids())  # Kept current by the USB watcher, no extra enumeration
     print(f"HWIDs: {usbHwids}")
     logger.info(f"HWIDs: {usbHwids}")
 
 
-def find_com_port_by_hwid_number(targetHwidNumber):
-    ports = serial.tools.list_ports.comports()
-    for port in ports:
-        # Print all device details for debugging purposes
-        print(f"Device: {port.device}, Description: {port.description}, HWID: {port.hwid}")
-        logger.info(f"Device: {port.device}, Description: {port.description}, HWID: {port.hwid}")
-        if targetHwidNumber in port.hwid:
-            logger.info('Hwid number: ' + targetHwidNumber + ' Located at: ' + port.device)
-            return port.device
-    return None
-
-
-def concat_port(comPort):
-    try:
-        print(f'Com Port: {comPort}')
-        logger.info(f'Com Port: {comPort}')
-        print('Serial Port Alias: ASRL' + comPort.replace("COM", '') + '::INSTR')
-        logger.info('Serial Port Alias: ASRL' + comPort.replace("COM", '') + '::INSTR')
-        return 'ASRL' + comPort.replace("COM", '') + '::INSTR'
-    except Exception as ex:
-        logger.error(f'Concat port error with {comPort}: {ex}')
-        print(f'Concat port error with {comPort}: {ex}')
-        return None
+# Driver Setup
+engine.hwids.update(instrumentHwids)
 
 
-# Avoid using COM# because windows can mix it up
+def start_drivers():
+    # Drivers load and connect in the background once the window is up, START waits for them
+    startupThread = Thread(target=engine.start_up, args=(simulateInstruments, resource_path('comtypes_gen')), daemon=True)
+    startupThread.start()
+    root.after(200, watch_startup)
 
-hypotComPort1 = find_com_port_by_hwid_number(hypotHwid1)
-portNumHy1 = concat_port(hypotComPort1)
 
-hypotComPort2 = find_com_port_by_hwid_number(hypotHwid2)
-portNumHy2 = concat_port(hypotComPort2)
+def watch_startup():
+    update_error_text()
+    if engine.startupReady.is_set():
+        startButton["state"] = "normal"
+        root.after(1000, watch_devices)
+    else:
+        root.after(200, watch_startup)
 
-switchComPort1 = find_com_port_by_hwid_number(switchHwid1)
-portNumSC1 = concat_port(switchComPort1)
 
-switchComPort2 = find_com_port_by_hwid_number(switchHwid2)
-portNumSC2 = concat_port(switchComPort2)
+def watch_devices():
+    update_error_text()  # Shows instruments the USB watcher lost or reconnected
+    root.after(1000, watch_devices)
 
-
-# Driver Setup
-try:
-    hypotDriver1 = cc.CreateObject('ARI38XX.ARI38XX', interface=ARI38XXLib.IARI38XX)
-    hypotDriver1.Initialize(portNumHy1, True, False, 'DriverSetup=BaudRate=38400, QueryInstrStatus=true')
-    print(f"Hypot1 Port: {portNumHy1}")
-    logger.info(f"Hypot1 Port: {portNumHy1}")
-except Exception as e:
-    print(f'Connection to Hypot1 failed: {e}')
-    logger.error(f'Connection to Hypot1 failed: {e}')
-    errors.append('Connection to Hypot1 failed')
-
-try:
-    hypotDriver2 = cc.CreateObject('ARI38XX.ARI38XX', interface=ARI38XXLib.IARI38XX)
-    hypotDriver2.Initialize(portNumHy2, True, False, 'DriverSetup=BaudRate=38400, QueryInstrStatus=true')
-    print(f"Hypot2 Port: {portNumHy2}")
-    logger.info(f"Hypot2 Port: {portNumHy2}")
-except Exception as e:
-    print(f'Connection to Hypot2 failed: {e}')
-    logger.error(f'Connection to Hypot2 failed: {e}')
-    errors.append('Connection to Hypot2 failed')
-
-try:
-    switchDriver1 = cc.CreateObject('SC6540.SC6540', interface=SC6540Lib.ISC6540)
-    switchOptionString1 = 'Cache=false, InterchangeCheck=false, QueryInstrStatus=true, RangeCheck=false, RecordCoercions=false, Simulate=false'
-    switchDriver1.Initialize(portNumSC1, True, False, switchOptionString1)
-    print(f"Switch1 Port: {portNumSC1}")
-    logger.info(f"Switch1 Port: {portNumSC1}")
-except Exception as e:
-    print(f'Connection to SC6540 Switch1 failed: {e}')
-    logger.error(f'Connection to SC6540 Switch1 failed: {e}')
-    errors.append('Connection to SC6540 Switch1 failed')
-try:
-    switchDriver2 = cc.CreateObject('SC6540.SC6540', interface=SC6540Lib.ISC6540)
-    switchOptionString2 = 'Cache=false, InterchangeCheck=false, QueryInstrStatus=true, RangeCheck=false, RecordCoercions=false, Simulate=false'
-    switchDriver2.Initialize(portNumSC2, True, False, switchOptionString2)
-    print(f"Switch2 Port: {portNumSC2}")
-    logger.info(f"Switch2 Port: {portNumSC2}")
-except Exception as e:
-    print(f'Connection to SC6540 Switch2 failed: {e}')
-    logger.error(f'Connection to SC6540 Switch2 failed: {e}')
-    errors.append('Connection to SC6540 Switch2 failed')
+# Results Database
+engine.resultsStore = results.ResultsStore(resource_path('results.db'))
+engine.resultsStore.start()
+engine.tracer = tracing.Tracer(resource_path('metrics.prom'), resource_path('spans.csv') if spanLogging else None)
 
 
 def get_settings():
-    config.read('settings.ini')
-    global errors
+    config.read(settingsPath)
     global adminPassword
-    global hypotHwid1
-    global hypotHwid2
-    global switchHwid1
-    global switchHwid2
     try:
         adminPassword = config['Admin']['Password']
     except Exception as ex:  # Revert to default if password is missing in settings file
         logger.error(f'Error Getting Admin Password: {ex}')
         adminPassword = '6789'
         config['Admin']['Password'] = '6789'
-    for x in range(1, 11):
+    for x in engine.cavityMap:
         cav = 'cavity' + str(x)
         try:
             runCavity[cav] = tk.IntVar(value=int(config['Run Cavity'][cav]))
@@ -242,6 +169,29 @@ def get_settings():
             logger.error(f"Error reading Settings.ini file, creating new enabled variables. {ex}")
             runCavity[cav] = tk.IntVar(value=1)
             laserEnabled[cav] = tk.IntVar(value=1)
+    apply_cavity_settings()
+    # Laser
+    try:
+        engine.laserPipelined = bool(int(config['Laser']['pipelined']))
+    except Exception as ex:
+        logger.error(f"No laser pipelined var in settings.ini, defaulting to on: {ex}")
+        engine.laserPipelined = True
+    try:
+        engine.laserDeferRetests = bool(int(config['Laser']['deferretests']))
+    except Exception as ex:
+        logger.error(f"No laser deferretests var in settings.ini, defaulting to off: {ex}")
+        engine.laserDeferRetests = False
+    try:
+        engine.scanMode = bool(int(config['Hypot']['scanmode']))
+    except Exception as ex:
+        logger.error(f"No hypot scanmode var in settings.ini, defaulting to off: {ex}")
+        engine.scanMode = False
+    try:
+        engine.retestLimit = int(config['Hypot']['retests'])
+    except Exception as ex:
+        logger.error(f"No hypot retests var in settings.ini, defaulting to 0: {ex}")
+        engine.retestLimit = 0
+
     # Hypot
     for key, defaultValue in defaultHypotSettings.items():
         # Make sure values exist
@@ -254,8 +204,11 @@ def get_settings():
         try:
             if key in ('arcdetection', 'continuitytest'):
                 hypotSettings[key] = bool(value)
-            elif key in ('voltage', 'currenthighlimit', 'currentlowlimit', 'arcsenselevel', 'frequency'):
+            elif key in ('voltage', 'currenthighlimit', 'currentlowlimit', 'arcsenselevel'):
                 hypotSettings[key] = int(value)
+            elif key == 'frequency':
+                hypotSettings[key] = engine.hypot_frequency_setting(value)
+                config['Hypot'][key] = hypotSettings[key]  # Written back in the new form on the next save
             elif key in ('rampuptime', 'rampdowntime', 'dwelltime', 'highlimitresistance', 'lowlimitresistance', 'resistanceoffset'):
                 hypotSettings[key] = float(value)
         except Exception as ex:
@@ -264,37 +217,21 @@ def get_settings():
             errors.append("Error reading Settings.ini! Delete it, restart Program!")
 
     updateHWIDS = {}
-    try:
-        hypotHwid1 = config['Hardware IDs']['hypot1']
-    except Exception as ex:
-        logger.error(f"No hypot1 hwid var in settings.ini: {ex}")
-        print(f"No hypot1 hwid var in settings.ini: {ex}")
-        updateHWIDS['hypot1'] = hypotHwid1
-    try:
-        hypotHwid2 = config['Hardware IDs']['hypot2']
-    except Exception as ex:
-        logger.error(f"No hypot2 hwid var in settings.ini: {ex}")
-        print(f"No hypot2 hwid var in settings.ini: {ex}")
-        updateHWIDS['hypot2'] = hypotHwid2
-    try:
-        switchHwid1 = config['Hardware IDs']['switch1']
-    except Exception as ex:
-        logger.error(f"No switch1 hwid var in settings.ini: {ex}")
-        print(f"No switch1 hwid var in settings.ini: {ex}")
-        updateHWIDS['switch1'] = switchHwid1
-    try:
-        switchHwid2 = config['Hardware IDs']['switch2']
-    except Exception as ex:
-        logger.error(f"No switch2 hwid var in settings.ini: {ex}")
-        print(f"No switch2 hwid var in settings.ini: {ex}")
-        updateHWIDS['switch2'] = switchHwid2
+    for device in engine.driverLabels:  # One hwid per instrument in the topology
+        try:
+            instrumentHwids[device] = config['Hardware IDs'][device]
+        except Exception as ex:
+            logger.error(f"No {device} hwid var in settings.ini: {ex}")
+            print(f"No {device} hwid var in settings.ini: {ex}")
+            updateHWIDS[device] = instrumentHwids[device]
 
     for device, hwid in updateHWIDS.items():    # Call to write hwids to settings.ini if they're missing
         default_hwid_conf(device, hwid)
+    engine.hwids.update(instrumentHwids)
 
 
 def default_hwid_conf(device, hwid):
-    with open('settings.ini', 'w') as configfile:
+    with open(settingsPath, 'w') as configfile:
         config['Hardware IDs'][device] = hwid
         config.write(configfile)
 
@@ -303,11 +240,11 @@ def save_settings():
     # Write the config object to a file
     print("Attempting to Save Settings")
     logger.info("Attempting to Save Settings")
-    with open('settings.ini', 'w') as configfile:
+    with open(settingsPath, 'w') as configfile:
         if config['Admin']['Password']:
             global adminPassword
             adminPassword = config['Admin']['Password']
-        for x in range(1, 11):
+        for x in engine.cavityMap:
             cav = 'cavity' + str(x)
             config['Run Cavity'][cav] = str(runCavity[cav].get())
             config['Laser Enabled'][cav] = str(laserEnabled[cav].get())
@@ -315,31 +252,23 @@ def save_settings():
         for key, value in hypotTkinterObjs.items():
             config['Hypot'][key] = str(value.get())
         config['Hypot']['arcdetection'] = str(hypotArcDetectionBool.get())
+        config['Laser']['pipelined'] = str(int(engine.laserPipelined))
+        config['Laser']['deferretests'] = str(int(engine.laserDeferRetests))
+        config['Hypot']['scanmode'] = str(int(engine.scanMode))
+        config['Hypot']['retests'] = str(engine.retestLimit)
         config.write(configfile)  # Close and save to settings file
+    apply_cavity_settings()  # update_colors draws from the batch state
     update_colors(canvas)
 
 
 def save_hwids():
-    if hypotHwid1 != config['Hardware IDs']['hypot1']:
-        try:
-            config['Hardware IDs']['hypot1'] = hypotHwid1
-        except Exception as ex:
-            logger.error(f"Error Connecting to or Saving Hypot 1 to settings file! {ex}")
-    if hypotHwid2 != config['Hardware IDs']['hypot2']:
-        try:
-            config['Hardware IDs']['hypot2'] = hypotHwid2
-        except Exception as ex:
-            logger.error(f"Error Connecting to or Saving Hypot 2 to settings file! {ex}")
-    if switchHwid1 != config['Hardware IDs']['switch1']:
-        try:
-            config['Hardware IDs']['switch1'] = switchHwid1
-        except Exception as ex:
-            logger.error(f"Error Connecting to or Saving Switch 1 to settings file! {ex}")
-    if switchHwid2 != config['Hardware IDs']['switch2']:
-        try:
-            config['Hardware IDs']['switch2'] = switchHwid2
-        except Exception as ex:
-            logger.error(f"Error Connecting to or Saving Switch 2 to settings file! {ex}")
+    for device, hwid in instrumentHwids.items():
+        if hwid != config['Hardware IDs'].get(device):
+            try:
+                default_hwid_conf(device, hwid)
+            except Exception as ex:
+                logger.error(f"Error Connecting to or Saving {engine.driverLabels[device]} to settings file! {ex}")
+    engine.hwids.update(instrumentHwids)
 
 
 def fault():
@@ -362,20 +291,28 @@ def fault():
     continuityFaultList = {}
     continuityFaultHeader = tk.Label(faultWindow, text='Continuity Failures', font=helvUnderline, fg=textColor, bg=faultBackgroundColor)
     continuityFaultHeader.grid(row=1, column=0, columnspan=2, pady=5)
-    for cavity, value in cavityContinuitySuccesses.items():
-        if not value:  # If failed continuity test
-            logger.info('Continuity fail on Cavity: ' + str(cavity))
-            continuityFaultList[cavity] = tk.Label(faultWindow, text='Cavity ' + str(cavity), font=helvmedium, fg=textColor, bg=faultBackgroundColor)
-            continuityFaultList[cavity].grid(row=cavity + 2, column=0)
+    for cavity in engine.batchState.failures(engine.batchState.continuity):  # Cavities that failed the continuity test
+        logger.info('Continuity fail on Cavity: ' + str(cavity))
+        continuityFaultList[cavity] = tk.Label(faultWindow, text='Cavity ' + str(cavity), font=helvmedium, fg=textColor, bg=faultBackgroundColor)
+        continuityFaultList[cavity].grid(row=cavity + 2, column=0)
 
     hypotFaultList = {}
     hypotFaultHeader = tk.Label(faultWindow, text='Hypot Failures', font=helvUnderline, fg=textColor, bg=faultBackgroundColor)
     hypotFaultHeader.grid(row=1, column=3, columnspan=2, pady=5)
-    for cavity, value in cavityHypotSuccesses.items():
-        if not value:  # If failed continuity test
-            logger.info('Hypot fail on Cavity: ' + str(cavity))
-            hypotFaultList[cavity] = tk.Label(faultWindow, text='Cavity ' + str(cavity), font=helvmedium, fg=textColor, bg=faultBackgroundColor)
-            hypotFaultList[cavity].grid(row=cavity + 2, column=3)
+    for cavity in engine.batchState.failures(engine.batchState.hypot):  # Cavities that failed the hypot test
+        logger.info('Hypot fail on Cavity: ' + str(cavity))
+        hypotFaultList[cavity] = tk.Label(faultWindow, text='Cavity ' + str(cavity), font=helvmedium, fg=textColor, bg=faultBackgroundColor)
+        hypotFaultList[cavity].grid(row=cavity + 2, column=3)
+
+    laserFaultList = {}
+    if False in laserConfirmed.values():
+        laserFaultHeader = tk.Label(faultWindow, text='Laser Failures', font=helvUnderline, fg=textColor, bg=faultBackgroundColor)
+        laserFaultHeader.grid(row=1, column=5, columnspan=2, pady=5)
+    for cavity, value in laserConfirmed.items():
+        if not value:  # If the marking was never confirmed
+            logger.info('Laser fail on Cavity: ' + str(cavity))
+            laserFaultList[cavity] = tk.Label(faultWindow, text='Cavity ' + str(cavity), font=helvmedium, fg=textColor, bg=faultBackgroundColor)
+            laserFaultList[cavity].grid(row=cavity + 2, column=5)
 
 
 def non_fault():
@@ -397,142 +334,120 @@ def non_fault():
 
 
 def reset(closeWindow, window):
-    global faultState
-    faultState = False
+    global resetAfterId
     if closeWindow:
         window.destroy()
-    switchDriver1.Execution.DisableAllChannels()
-    switchDriver2.Execution.DisableAllChannels()
-    # Set all Output Variables to 0
-    for cavity in cavityContinuitySuccesses:
-        cavityContinuitySuccesses[cavity] = 0
-    for cavity in cavityHypotSuccesses:
-        cavityHypotSuccesses[cavity] = 0
-    time.sleep(1)  # Make sure double clicks dont accidentally start it again
-    startButton["state"] = "normal"  # Re-enables start button
-
-def create_hypot_tests():
-    for hypotDriver in [hypotDriver1, hypotDriver2]:
-        # Create file
-        try:
-            hypotDriver.Files.Create(2, 'LHChypot')
-            print(f'Hypot test created')
-            logger.info(f'Hypot test created')
-        except Exception as ex:
-            print(f'Hypot test exists, or Issue: {ex}')
-            logger.info(f'Hypot test exists, or Issue: {ex}')
-            hypotDriver.Files.Delete(2)
-            hypotDriver.Files.Create(2, 'LHChypot')
-        finally:
-            print(f'Unable to create hypot test. ERROR')
-            logger.error(f'Unable to create hypot test. ERROR')
-
-        # Hypot manual results read on page 83
-        #   Add ACW test item by AddACWTest()
-        try:
-            hypotDriver.Steps.AddACWTestWithDefaults()
-            hypotDriver.Parameters.Voltage = hypotSettings['voltage']
-            hypotDriver.Parameters.HighLimit = hypotSettings['currenthighlimit']
-            hypotDriver.Parameters.LowLimit = hypotSettings['currentlowlimit']
-            hypotDriver.Parameters.RampUp = hypotSettings['rampuptime']
-            hypotDriver.Parameters.Dwell = hypotSettings['dwelltime']
-            hypotDriver.Parameters.RampDown = hypotSettings['rampdowntime']
-            hypotDriver.Parameters.ArcSense = hypotSettings['arcsenselevel']
-            hypotDriver.Parameters.ArcDetectEnabled = hypotSettings['arcdetection']
-            hypotDriver.Parameters.Frequency = hypotSettings['frequency']
-            hypotDriver.Parameters.ContinuityEnabled = hypotSettings['continuitytest']
-            hypotDriver.Parameters.ContHiLimit = hypotSettings['highlimitresistance']
-            hypotDriver.Parameters.ContLoLimit = hypotSettings['lowlimitresistance']
-            hypotDriver.Parameters.ContOffset = hypotSettings['resistanceoffset']
-            hypotDriver.Files.Save()
-        except Exception as ex:
-            logger.error(f"Error creating hypot test on hypot1: {ex}")
-            print(f"Error creating hypot test on hypot1: {ex}")
+    engine.reset_batch()
+    startButton["state"] = "disabled"
+    if resetAfterId is not None:  # Another reset restarts the wait
+        root.after_cancel(resetAfterId)
+    resetAfterId = root.after(resetDebounce, enable_start)
 
 
+def enable_start():
+    global resetAfterId
+    resetAfterId = None
+    if engine.startupReady.is_set():
+        startButton["state"] = "normal"  # Re-enables start button
+
+
+def calibrate_relays():
+    def run_calibration():
+        error = engine.calibrate_switches()
+        if error:
+            errors.append(error)
+    Thread(target=run_calibration, daemon=True).start()
+
 def start():
-    startButton["state"] = "disabled"  # Disabled start button so its not running twice at the same time due to threading
-    disabledCavs = 0
-    create_hypot_tests()
-    global faultState
-    for cavity, value in runCavity.items():
-        if value.get() == 0:
-            disabledCavs += 1
-    totalProgressBar['value'] = (disabledCavs * 10)
-    totalProgressPercentage.configure(text=str(int(totalProgressBar['value'])) + ' %')  # Updates displayed percentage. Conv to int to remove decimals
-    for i in range(1, 11):
-        cavityContinuitySuccesses[i] = 0
-        cavityHypotSuccesses[i] = 0
-
-    for cavity, value in runCavity.items():
-        cavitynum = ''.join([char for char in cavity if char.isdigit()])
-        cavitynum = int(cavitynum)
-        if value.get() == 1:    # If cavity Enabled
-            print('Running Cavity: ' + str(cavitynum))
-            logger.info('Running Cavity: ' + str(cavitynum))
-
-            switchDriver1.Execution.DisableAllChannels()
-            switchDriver2.Execution.DisableAllChannels()
-
-            hypot_setup(cavitynum)
-            hypot_execution(cavityNum=cavitynum)
-
-            switchDriver1.Execution.DisableAllChannels()
-            switchDriver2.Execution.DisableAllChannels()
-
-            totalProgressBar.step(10)
-            totalProgressPercentage.configure(text=str(int(totalProgressBar['value'])) + ' %')  # Updates displayed percentage. Conv to int to remove decimals
-        else: # If cavity Disabled
-            cavityContinuitySuccesses[cavitynum] = 3
-            cavityHypotSuccesses[cavitynum] = 3  # Dont show on fault window, but don't do other functions either
-        if laserEnabled['cavity' + str(cavitynum)].get() == 1:
-            print('Lasering Cavity: ' + str(cavitynum))
-            logger.info('Lasering Cavity: ' + str(cavitynum))
-            laser(cavitynum)
+    try:
+        faultState = engine.start()
+    except Exception as ex:
+        logger.error(f'Batch stopped by an error: {ex}')
+        print(f'Batch stopped by an error: {ex}')
+        errors.append(f'Batch stopped by an error: {ex}')
+        faultState = True
+    engine.post_event('done', value=faultState)  # Fault window opens on the Tk thread
+
+
+def drain_ui_events():
+    # Everything the test threads posted since the last drain, only the newest state per cavity is drawn
+    cavityStates = {}
+    progress = None
+    done = None
+    while True:
+        try:
+            event, cavity, value = engine.uiEvents.get_nowait()
+        except queue.Empty:
+            break
+        if event == 'progress':
+            progress = value
+        elif event == 'done':
+            done = value
+        elif event == 'spc':
+            update_trending_text(value)
         else:
-            print('Laser Disabled. Skipping Cavity: ' + str(cavitynum))
-            logger.info('Laser Disabled. Skipping Cavity: ' + str(cavitynum))
-        print(f"Continuity results: {cavityContinuitySuccesses}")
-        logger.info(f"Continuity results: {cavityContinuitySuccesses}")
-        print(f"Hypot results:      {cavityHypotSuccesses}")
-        logger.info(f"Hypot results:      {cavityHypotSuccesses}")
-
-        if cavityContinuitySuccesses[cavitynum] == 0 or cavityHypotSuccesses[cavitynum] == 0:
-            print(f"Fault State True")
-            logger.info(f"Fault State True")
-            faultState = True
-
-        print('=================================')  # Separate cavities for testing readability
-    if faultState:  # If any part has a problem, have operators acknowledge they took care of it before starting again
-        fault()
-    else:
-        non_fault()
+            cavityStates[cavity] = (event, value)
+    if progress is not None:
+        update_progress(progress)
+    for cavity, (event, value) in cavityStates.items():
+        show_cavity_state(cavity, event, value)
+    if done is not None:
+        if done:  # If any part has a problem, have operators acknowledge they took care of it before starting again
+            fault()
+        else:
+            non_fault()
+    root.after(uiEventInterval, drain_ui_events)
+
+
+def show_cavity_state(cavNum, event, value):
+    if event == 'running':
+        change_rectangle_color(cavNum=cavNum, color=runningColor, canv=canvas)
+        update_rectangle_text(cavNum=cavNum, text='Testing')
+    elif event == 'passed':
+        change_rectangle_color(cavNum=cavNum, color=enabledColor, canv=canvas)
+        update_rectangle_text(cavNum=cavNum, text='Passed')
+    elif event == 'failed':
+        change_rectangle_color(cavNum=cavNum, color=disabledColor, canv=canvas)
+        update_rectangle_text(cavNum=cavNum, text='Failed ' + value)
+    elif event == 'lasering':
+        change_rectangle_color(cavNum=cavNum, color=enabledColor, canv=canvas)  # Passed may have been coalesced away
+        update_rectangle_text(cavNum=cavNum, text='Lasering')
+    elif event == 'marked':
+        change_rectangle_color(cavNum=cavNum, color=enabledColor, canv=canvas)  # Passed may have been coalesced away
+        update_rectangle_text(cavNum=cavNum, text='Passed, Marked')
+    elif event == 'laser failed':
+        change_rectangle_color(cavNum=cavNum, color=halfDisabledColor, canv=canvas)
+        update_rectangle_text(cavNum=cavNum, text='Laser Failed')
+
+
+def update_progress(value):
+    totalProgressBar['value'] = value
+    totalProgressPercentage.configure(text=str(int(totalProgressBar['value'])) + ' %')  # Updates displayed percentage. Conv to int to remove decimals
 
 
 def start_start():  # This is to put the main loop on a separate thread so it can be emergency stopped
+    startButton["state"] = "disabled"  # Disabled start button so its not running twice at the same time due to threading
+    apply_cavity_settings()  # Engine runs the batch on a snapshot of the current settings
+    update_colors(canvas)  # Clear the last batch's results
     mainThread = Thread(target=start)
     mainThread.start()
 
-def close_drivers():
-    hypotDriver1.close()
-    hypotDriver2.close()
-    switchDriver1.close()
-    switchDriver2.close()
-
 def stop():
     logger.error('Emergency Stop Used!')
     print('Emergency Stop Used!')
     try:
-        switchDriver1.Execution.DisableAllChannels()
-        switchDriver2.Execution.DisableAllChannels()
-        close_drivers()
+        engine.disable_all_switches()
+        engine.close_drivers()
+        engine.resultsStore.stop()  # Write whatever is still queued before exiting
         print('Program exited cleanly')
+        stop_logging()
         # noinspection PyProtectedMember
         os._exit(os.X_OK)  # Force exits program with status OK
     except Exception as ex:
         logger.error(f"Error during emergency stop!: {ex}")
         print(f"Error during emergency stop!: {ex}")
-        close_drivers()
+        engine.close_drivers()
+        stop_logging()
         # noinspection PyProtectedMember
         os._exit(os.X_OK)  # Force exits program with status OK
     finally:
@@ -543,131 +458,16 @@ def stop():
         os._exit(os.X_OK)  # Force exits program with status OK
 
 
+def stop_logging():
+    if logListener is not None:
+        logListener.stop()  # Writes out the queued records, os._exit skips every other cleanup
+
+
 def on_stop_button_clicked():
     stopThread = Thread(target=stop)
     stopThread.start()
 
 
-def hypot_setup(cavitynum):
-    if (cavitynum <= 5):  # First sc6540 switch and hypot
-        switchDriver = switchDriver1
-    else:  # Second sc6540 switch and hypot
-        switchDriver = switchDriver2
-        cavitynum -= 5 # Reduce value for proper switch port assignments
-
-    # Enable Return (Low) channels
-    rtnChannel = 2 * cavitynum - 1
-    highChannel = 2 * cavitynum
-
-    switchDriver.Execution.ConfigureWithstandChannels({highChannel})
-    switchDriver.Execution.ConfigureReturnChannels({rtnChannel})
-
-    # After the multiplexer was configured, the safety tester could start output for withstand test on those connections.
-    time.sleep(0.1)
-
-    logger.info('Hypot Setup Done')
-    print('Hypot Setup Done')
-
-
-def hypot_execution(cavityNum):
-    if cavityNum <= 5:
-        hypotDriver = hypotDriver1
-    else:
-        hypotDriver = hypotDriver2
-
-    try:
-        # Start test
-        hypotDriver.Execution.Execute()
-        # Output Results
-        read_hypot(hypotDriver=hypotDriver, cavityNum=cavityNum)
-    except Exception as ex:
-        logger.error('Exception occured at Hypot execution: ' + str(ex))
-        errors.append('Exception occured at Hypot execution: ' + str(ex))
-        print('Exception occured at Hypot execution: ' + str(ex))
-
-    hypotDriver.Execution.Abort()
-    print('Hypot Execution Done')
-    logger.info('Hypot Execution Done')
-
-
-def read_hypot(hypotDriver, cavityNum):
-    global faultState
-    lastOpcStatus = False
-    while (True):
-        output = hypotDriver.Execution.ReadTestDisplayRaw().split(',')  # Split into an array for data parsing
-        print(output)
-        logger.info('Raw Output: ' + hypotDriver.Execution.ReadTestDisplayRaw())
-
-        hypotDriver.System.WriteString('*OPC?\n')
-        opcStatus = hypotDriver.System.ReadString()
-
-        continuityFailureTypes = ['Cont. Hi-Lmt']
-        hypotFailureTypes = ['HI-LIMIT', 'Short', 'Breakdown']
-        if ('1' in opcStatus and lastOpcStatus):
-            # Successes
-            if output[2] == 'PASS':
-                cavityHypotSuccesses[cavityNum] = 1
-                cavityContinuitySuccesses[cavityNum] = 1
-                print('Cavity ' + str(cavityNum) + ' passes hypot & continuity')
-                logger.info('Cavity ' + str(cavityNum) + ' passes hypot & continuity')
-            elif output[2] in continuityFailureTypes:
-                cavityContinuitySuccesses[cavityNum] = 0
-                cavityHypotSuccesses[cavityNum] = 2
-                print('Cavity ' + str(cavityNum) + ' fails Continuity')
-                logger.info('Cavity ' + str(cavityNum) + ' fails Continuity')
-                faultState = True
-            elif output[2] in hypotFailureTypes:
-                cavityContinuitySuccesses[cavityNum] = 1
-                cavityHypotSuccesses[cavityNum] = 0
-                print('Cavity ' + str(cavityNum) + ' fails Hypot')
-                logger.info('Cavity ' + str(cavityNum) + ' fails Hypot')
-                faultState = True
-            break
-        lastOpcStatus = '1' in opcStatus
-        time.sleep(0.1)
-
-def laser(cavityNum):
-    if cavityHypotSuccesses[cavityNum] == 1 and cavityContinuitySuccesses[cavityNum] == 1:  # Only Laser if passes both tests
-        if send_laser('RX,Ready\r').split(',')[1] == 'OK':
-            cavityNum -= 1 # Laser programs array starts at 0
-            send_laser('WX,ProgramNo='+str(cavityNum)+'\r')
-            send_laser('WX,StartMarking\r')
-            send_laser('RX,ProgramNo\r')
-        else:
-            print('Laser not ready, skipping')
-            logger.info('Laser not ready, skipping')
-    else:
-        print('Skipping Laser due to failed cont or hypot')
-        logger.info('Skipping Laser due to failed cont or hypot')
-
-    print('Laser Done')
-    logger.info('Laser Done')
-
-def send_laser(msg):
-    try:
-        print(f'Sending to laser: {msg}')
-        logger.info(f'Sending to laser: {msg}')
-        laserSocket.send(msg.encode('utf-8'))
-        return read_laser()
-    except Exception as ex:
-        logger.error(f'Issue sending commands to Laser Marker: {ex}')
-        print(f'Issue sending commands to Laser Marker: {ex}')
-        return 'ng,ng,ng'  # Return no good string
-
-
-def read_laser():
-    try:
-        response = laserSocket.recv(1024)  # Listens for data, max amount of bytes specified in ()
-        response = response.decode('utf-8')  # Converts bytes to string
-        print(f'Laser Output: {response}')
-        logger.info(f'Laser Output: {response}')
-        return response
-    except Exception as ex:
-        logger.error(f'Issue receiving commands from Laser Marker: {ex}')
-        print(f'Issue receiving commands from Laser Marker: {ex}')
-        return 'ng,ng,ng'   # Return no good string
-
-
 def admin_panel():
     get_settings()
     def toggle_cavity():
@@ -680,6 +480,7 @@ def admin_panel():
 
     def quit_admin():
         adminWindow.destroy()
+        apply_cavity_settings()
         update_colors(canvas)
         adminTextbox.delete(0, 'end')  # Clears Password
 
@@ -710,36 +511,31 @@ def admin_panel():
         laserHeaderLabel = tk.Label(adminWindow, text='Enable/Disable Laser', font=helv, fg=textColor, bg=backgroundColor)
         laserHeaderLabel.grid(row=0, column=5, columnspan=2)
 
+        checkboxRows = math.ceil(len(engine.cavityMap) / 2)  # Cavities split over two columns, buttons go below them
         save_settingsButton = tk.Button(adminWindow, text='Save', command=save_settings, bg='#000000', fg=textColor, relief='flat', width=7, height=2, font=helvmedium)
-        save_settingsButton.grid(row=9, column=4, padx=3, pady=3)
+        save_settingsButton.grid(row=checkboxRows + 4, column=4, padx=3, pady=3)
 
         closeAdminButton = tk.Button(adminWindow, text='Close', command=quit_admin, bg='#000000', fg=textColor, relief='flat', width=7, height=2, font=helvmedium)
-        closeAdminButton.grid(row=10, column=4, padx=3, pady=3)
+        closeAdminButton.grid(row=checkboxRows + 5, column=4, padx=3, pady=3)
 
         toggleCavityButton = tk.Button(adminWindow, text='Toggle Cavity', command=toggle_cavity, bg='#000000', fg=textColor, relief='flat', width=12, height=2, font=helvmedium)
-        toggleCavityButton.grid(row=7, column=2, padx=3, pady=3)
+        toggleCavityButton.grid(row=checkboxRows + 2, column=2, padx=3, pady=3)
         toggleLaserButton = tk.Button(adminWindow, text='Toggle Laser', command=toggle_laser, bg='#000000', fg=textColor, relief='flat', width=12, height=2, font=helvmedium)
-        toggleLaserButton.grid(row=7, column=5, padx=3, pady=3)
+        toggleLaserButton.grid(row=checkboxRows + 2, column=5, padx=3, pady=3)
 
         resetButton = tk.Button(adminWindow, text='Reset', command=lambda: reset(closeWindow=False, window=adminWindow), bg='#000000', fg=textColor, relief='flat', width=7, height=2, font=helvmedium)
-        resetButton.grid(row=10, column=6, padx=3, pady=3)
+        resetButton.grid(row=checkboxRows + 5, column=6, padx=3, pady=3)
 
         cavityCheckBoxes = {}
-        for x in range(1, 11):
+        for i, x in enumerate(engine.cavityMap):
             cavityCheckBoxes[x] = Checkbutton(adminWindow, text='Cavity' + str(x), variable=runCavity['cavity' + str(x)], onvalue=1, offvalue=0, fg='white', selectcolor='Black', bg=backgroundColor, font=helvmedium)
-            if x < 6:
-                cavityCheckBoxes[x].grid(row=x, column=1)
-            else:
-                cavityCheckBoxes[x].grid(row=x - 5, column=2)
+            cavityCheckBoxes[x].grid(row=i % checkboxRows + 1, column=1 + i // checkboxRows)
         laserCheckBoxes = {}
-        for x in range(1, 11):
+        for i, x in enumerate(engine.cavityMap):
             laserCheckBoxes[x] = Checkbutton(adminWindow, text='Laser' + str(x),
                                              variable=laserEnabled['cavity' + str(x)], onvalue=1, offvalue=0, fg='white', selectcolor='Black', bg=backgroundColor,
                                              font=helvmedium)
-            if x < 6:
-                laserCheckBoxes[x].grid(row=x, column=5)
-            else:
-                laserCheckBoxes[x].grid(row=x - 5, column=6)
+            laserCheckBoxes[x].grid(row=i % checkboxRows + 1, column=5 + i // checkboxRows)
 
         # Breaks up view a bit, improves legibility
         verticalSeparator = Frame(adminWindow, bg="red", height=800, width=2)
@@ -825,6 +621,8 @@ def admin_panel():
 
         hardwareSettingsButton = tk.Button(adminWindow, text='Hardware\nSettings', command=hardware_settings, bg='#000000', fg=textColor, relief='flat', width=11, height=3, font=helvsmall)
         hardwareSettingsButton.grid(row=12, column=4)
+        calibrateButton = tk.Button(adminWindow, text='Calibrate\nRelays', command=calibrate_relays, bg='#000000', fg=textColor, relief='flat', width=11, height=3, font=helvsmall)
+        calibrateButton.grid(row=12, column=5)
 
     else: # Wrong password
         wrongPassLabel = tk.Label(root, text="Wrong Password!")
@@ -856,29 +654,23 @@ def hardware_settings():
     hardwareWindow.lift()
 
     get_usb_hwids()
-    hypot1Var = tk.StringVar()
-    hypot1Dropdown = ttk.Combobox(hardwareWindow, textvariable=hypot1Var, values=list(usbHwids))
-    hypot1Dropdown.pack(pady=10)
-    hypot2Var = tk.StringVar()
-    hypot2Dropdown = ttk.Combobox(hardwareWindow, textvariable=hypot2Var, values=list(usbHwids))
-    hypot2Dropdown.pack(pady=10)
-    switch1Var = tk.StringVar()
-    switch1Dropdown = ttk.Combobox(hardwareWindow, textvariable=switch1Var, values=list(usbHwids))
-    switch1Dropdown.pack(pady=10)
-    switch2Var = tk.StringVar()
-    switch2Dropdown = ttk.Combobox(hardwareWindow, textvariable=switch2Var, values=list(usbHwids))
-    switch2Dropdown.pack(pady=10)
+    hwidDropdowns = {}
+    for device, label in engine.driverLabels.items():  # One dropdown per instrument in the topology
+        hwidLabel = tk.Label(hardwareWindow, text=label, font=helvsmall, fg=textColor, bg=backgroundColor)
+        hwidLabel.pack()
+        hwidDropdowns[device] = ttk.Combobox(hardwareWindow, textvariable=tk.StringVar(), values=list(usbHwids))
+        hwidDropdowns[device].pack(pady=5)
     def set_default_hwid():
-        hypot1Dropdown.set(hypotHwid1)
-        hypot2Dropdown.set(hypotHwid2)
-        switch1Dropdown.set(switchHwid1)
-        switch2Dropdown.set(switchHwid2)
+        for device, dropdown in hwidDropdowns.items():
+            dropdown.set(instrumentHwids[device])
+    def save_hwid_dropdowns():
+        for device, dropdown in hwidDropdowns.items():
+            instrumentHwids[device] = dropdown.get()
+        save_hwids()
     hardwareWindow.update()
-    switch2Dropdown.update_idletasks()
-    switch1Dropdown.update()
     hardwareWindow.after(100, set_default_hwid())  # Pause for a bit otherwise default values are unset
 
-    save_hwidButton = tk.Button(hardwareWindow, text='Save', command=save_hwids, bg='#000000', fg=textColor, relief='flat', width=7, height=2, font=helvmedium)
+    save_hwidButton = tk.Button(hardwareWindow, text='Save', command=save_hwid_dropdowns, bg='#000000', fg=textColor, relief='flat', width=7, height=2, font=helvmedium)
     save_hwidButton.pack(pady=10)
 
     quitHardwareButton = tk.Button(hardwareWindow, text='Close', command=quit_hardware, bg='#000000', fg=textColor, relief='flat', width=7, height=2, font=helvmedium)
@@ -886,9 +678,12 @@ def hardware_settings():
 
 # Function to create a grid of rectangles and store references
 def create_rectangle_grid(rows, columns, rectWidth, rectHeight, padding, canv):
-    cavNum = 1
+    cavityNums = list(engine.cavityMap)  # Filled column by column in cavity order
     for col in range(columns):
         for row in range(rows):
+            if not cavityNums:
+                break
+            cavNum = cavityNums.pop(0)
             x1 = col * (rectWidth + padding)
             y1 = row * (rectHeight + padding)
             x2 = x1 + rectWidth
@@ -896,7 +691,6 @@ def create_rectangle_grid(rows, columns, rectWidth, rectHeight, padding, canv):
             rectangles[cavNum] = canv.create_rectangle(x1, y1, x2, y2, fill='green')
             canv.create_text((x1 + rectWidth / 2, y1 + 18), text="Cav " + str(cavNum), fill=textColor, font='tkDefaeultFont 20')
             statusText[cavNum] = canv.create_text((x1 + rectWidth / 2, y1 + rectHeight / 2 + 15), text="", fill=textColor, font='tkDefaeultFont 14')
-            cavNum += 1
     update_colors(canv)
 
 
@@ -908,15 +702,23 @@ def change_rectangle_color(cavNum, color, canv):
         print(f"No rectangle found at position {cavNum}")
 
 
+def apply_cavity_settings():
+    # Batch state follows the checkboxes between batches, a running batch keeps the settings it started with
+    if not engine.batchLock.locked():
+        engine.batchState.set_settings({x: runCavity['cavity' + str(x)].get() for x in engine.cavityMap},
+                                       {x: laserEnabled['cavity' + str(x)].get() for x in engine.cavityMap})
+
+
 def update_colors(canv):
-    for x in range(1, 11):
-        if laserEnabled['cavity' + str(x)].get() == 0 and runCavity['cavity' + str(x)].get() == 0:
+    batchState = engine.batchState
+    for x in batchState.cavities:
+        if not batchState.laserEnabled[x] and not batchState.runCavity[x]:
             change_rectangle_color(cavNum=x, color=disabledColor, canv=canv)
             update_rectangle_text(x, text="Fully Disabled")
-        elif runCavity['cavity' + str(x)].get() == 0:
+        elif not batchState.runCavity[x]:
             change_rectangle_color(cavNum=x, color=halfDisabledColor, canv=canv)
             update_rectangle_text(x, text="Hypot Disabled")
-        elif laserEnabled['cavity' + str(x)].get() == 0:
+        elif not batchState.laserEnabled[x]:
             change_rectangle_color(cavNum=x, color=halfDisabledColor, canv=canv)
             update_rectangle_text(cavNum=x, text="Laser Disabled")
         else:
@@ -932,21 +734,33 @@ def update_rectangle_text(cavNum, text):
         print(f"No rectangle found at position {cavNum}")
 
 def update_error_text():
-    if not errors:
+    pending = ['Connecting to ' + label + '...' for label in sorted(engine.pendingDevices.copy())]
+    if errors:
+        errorString = '\n'.join(errors + pending)
+        errorText.config(text=errorString, fg='red')
+    elif pending:
+        errorString = '\n'.join(pending)
+        errorText.config(text=errorString, fg=halfDisabledColor)
+    else:
         errorString = 'All Hardware Connected'
         errorText.config(text=errorString, fg='green')
+
+def update_trending_text(trending):
+    # Cavities still passing whose current or resistance is heading for its limit
+    if trending:
+        trendingText.config(text='\n'.join('Cav ' + str(x) + ': ' + ', '.join(trending[x]) for x in sorted(trending)), fg=halfDisabledColor)
     else:
-        errorString = '\n'.join(errors)
-        errorText.config(text=errorString, fg='red')
+        trendingText.config(text='No cavities trending', fg='green')
 
 # Setting values to make sure theyre populated when referenced, or if no settings file found initially
-for y in range(1, 11):
+for y in engine.cavityMap:
     c = 'cavity' + str(y)  # Using cavity(y) instead of int so settings file is a bit more readable
     runCavity[c] = tk.IntVar(value=0)
     laserEnabled[c] = tk.IntVar(value=0)
 
 # Get settings on program start
 get_settings()
+engine.load_spc_history()
 
 #       Starting UI Setup
 # Fonts and Styles
@@ -956,10 +770,12 @@ helvmedium = tkfont.Font(family='Helvetica', size=15, weight='bold')
 helvsmall = tkfont.Font(family='Helvetica', size=10, weight='bold')
 
 # UI Setup
-startButton = tk.Button(root, text='START', command=start_start, bg='#000000', fg=textColor, relief='flat', width=20, height=12, font=helv)
+startButton = tk.Button(root, text='START', command=start_start, bg='#000000', fg=textColor, relief='flat', width=20, height=12, font=helv, state='disabled')
 startButton.place(x=50, y=400)
 stopButton = tk.Button(root, text='Emergency STOP', command=on_stop_button_clicked, bg='#000000', fg=textColor, relief='flat', width=18, height=3, font=helvmedium)
 stopButton.place(x=850, y=875)
+engine.uiEvents = queue.SimpleQueue()
+root.after(uiEventInterval, drain_ui_events)
 root.protocol("WM_DELETE_WINDOW", on_stop_button_clicked)  # Gracefully shuts down program if window closed
 root.state('zoomed')
 
@@ -987,9 +803,22 @@ errorText = tk.Label(errorCanvas, text='', fg='red', bg=canvasColor, font=helvme
 errorText.place(x=0, y=0)
 update_error_text()
 
+trendingFrame = ttk.Frame(root, padding=(5, 5, 5, 5), width=520, height=270)
+trendingFrame.place(x=450, y=400)
+trendingCanvas = Canvas(trendingFrame, width=500, height=250, bg=canvasColor, highlightthickness=5, highlightbackground=canvasColor)
+trendingCanvas.place(x=0, y=0)
+trendingLabel = tk.Label(trendingCanvas, text='Trending Cavities', fg=textColor, bg=canvasColor, font=helvmedium)
+trendingLabel.place(x=0, y=0)
+trendingText = tk.Label(trendingCanvas, text='', fg='green', bg=canvasColor, font=helvsmall, justify='left')
+trendingText.place(x=0, y=35)
+update_trending_text(engine.spcTrending)
+
 
 # Create the grid of rectangles
-create_rectangle_grid(rows=5, columns=2, rectWidth=300, rectHeight=100, padding=50, canv=canvas)
+gridRows, gridColumns = fixtureTopology['grid']  # Stock fixture is 5 x 2 of 300 x 100 with 50 between, larger ones shrink to fit
+create_rectangle_grid(rows=gridRows, columns=gridColumns, rectWidth=min(300, (650 - 50 * (gridColumns - 1)) // gridColumns),
+                      rectHeight=min(100, (700 - 50 * (gridRows - 1)) // gridRows),
+                      padding=50, canv=canvas)
 
 # Admin UI
 adminLabel = tk.Label(root, text='Admin Settings', fg=textColor, bg=textBackgroundColor, font=helv)
@@ -1011,6 +840,7 @@ for widget in root.winfo_children(): # Close admin window
         widget.destroy()
 adminTextbox.delete(0, 'end')  # Clears Password
 root.lift()
+start_drivers()
 #Test each cavity
 #switchDriver1.Execution.DisableAllChannels()
 #switchDriver2.Execution.DisableAllChannels()
@@ -0,0 +1,82 @@
+import array
+import enum
+
+
+# Batch State: each cavity's settings and results for the batch being run, in byte arrays indexed by cavity number, and a ring of past batches
+class Result(enum.IntEnum):
+    FAILED = 0  # Also every cavity's result until its test finishes
+    PASSED = 1
+    SKIPPED = 2  # Hypot not judged, continuity failed
+    DISABLED = 3  # Cavity not run this batch, left off the fault window
+
+
+class PastBatch:
+    __slots__ = ('batchId', 'fault', 'hypot', 'continuity', 'laserEnabled')
+
+    def __init__(self, batchId, fault, hypot, continuity, laserEnabled):
+        self.batchId = batchId
+        self.fault = fault
+        self.hypot = hypot  # Frozen copies of the arrays, same cavity indexing
+        self.continuity = continuity
+        self.laserEnabled = laserEnabled
+
+    def passed(self, cavity):
+        return self.hypot[cavity] == Result.PASSED and self.continuity[cavity] == Result.PASSED
+
+
+class BatchState:
+
+    def __init__(self, cavities, historySize=100):
+        self.cavities = tuple(cavities)  # Topology order
+        self.size = max(self.cavities, default=0) + 1  # Slots no cavity uses stay zero and are never read
+        self.runCavity = array.array('B', bytes(self.size))  # 1 to test the cavity, copied from the settings before each batch
+        self.laserEnabled = array.array('B', bytes(self.size))  # 1 to mark it once it passes
+        self.hypot = array.array('B', bytes(self.size))  # Result of each cavity
+        self.continuity = array.array('B', bytes(self.size))
+        self.history = [None] * historySize  # PastBatch ring, the oldest is overwritten
+        self.historyNext = 0
+
+    def set_settings(self, runCavity=None, laserEnabled=None):
+        # {cavity: 1/0}, cavities left out keep what they had
+        for cavity, value in (runCavity or {}).items():
+            self.runCavity[cavity] = int(value)
+        for cavity, value in (laserEnabled or {}).items():
+            self.laserEnabled[cavity] = int(value)
+
+    def clear_results(self):
+        self.hypot[:] = array.array('B', bytes(self.size))
+        self.continuity[:] = array.array('B', bytes(self.size))
+
+    def set_result(self, cavity, hypot, continuity):
+        self.hypot[cavity] = hypot
+        self.continuity[cavity] = continuity
+
+    def passed(self, cavity):
+        return self.hypot[cavity] == Result.PASSED and self.continuity[cavity] == Result.PASSED
+
+    def failed(self, cavity):
+        return self.hypot[cavity] == Result.FAILED or self.continuity[cavity] == Result.FAILED
+
+    def disabled_count(self):
+        return sum(1 for cavity in self.cavities if not self.runCavity[cavity])
+
+    def failures(self, results):
+        # Cavities that failed in self.hypot or self.continuity
+        return [cavity for cavity in self.cavities if results[cavity] == Result.FAILED]
+
+    def result_map(self, results):
+        return {cavity: results[cavity] for cavity in self.cavities}
+
+    def archive(self, batchId, fault):
+        self.history[self.historyNext] = PastBatch(batchId, fault, bytes(self.hypot), bytes(self.continuity), bytes(self.laserEnabled))
+        self.historyNext = (self.historyNext + 1) % len(self.history)
+
+    def recent(self, count=None):
+        # Past batches, newest first
+        batches = []
+        for offset in range(1, len(self.history) + 1):
+            pastBatch = self.history[(self.historyNext - offset) % len(self.history)]
+            if pastBatch is None or (count is not None and len(batches) >= count):
+                break
+            batches.append(pastBatch)
+        return batches
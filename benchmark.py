@@ -0,0 +1,206 @@
+import argparse
+import contextlib
+import io
+import json
+import logging
+import os
+import statistics
+import sys
+import tempfile
+import time
+from threading import Lock
+
+import engine
+import instruments
+import logqueue
+import topology
+
+
+# Cycle time benchmark: runs the real engine.start() batch against simulated instruments with realistic latencies
+phaseNames = ('create_hypot_tests', 'create_scan_tests', 'run_scan', 'hypot_setup', 'hypot_execution', 'read_hypot', 'laser', 'send_laser_commands', 'update_spc')
+phaseTimes = {}  # phase: seconds per call, for the batch being run
+phaseLock = Lock()
+
+
+def timed_phase(name, function):
+    def wrapper(*args, **kwargs):
+        startTime = time.perf_counter()
+        try:
+            return function(*args, **kwargs)
+        finally:
+            with phaseLock:
+                phaseTimes[name].append(time.perf_counter() - startTime)
+    return wrapper
+
+
+def percentile(values, percent):
+    if not values:
+        return 0.0
+    if len(values) == 1:
+        return values[0]
+    return statistics.quantiles(values, n=100, method='inclusive')[percent - 1]
+
+
+def summarize(values):
+    return {'count': len(values), 'mean': statistics.fmean(values) if values else 0.0,
+            'p50': percentile(values, 50), 'p95': percentile(values, 95), 'p99': percentile(values, 99)}
+
+
+def setup_fixture(args):
+    engine.apply_topology(topology.load_topology(args.config))
+    engine.load_driver_libraries(True)
+    engine.hwids.update({name: 'SIM' + name.upper() for name in engine.driverLabels})
+    outcomes = {'PASS': 1.0 - args.fail_rate, 'HI-LIMIT': args.fail_rate / 2, 'Cont. Hi-Lmt': args.fail_rate / 2}
+    for name in engine.driverLabels:
+        if name.startswith('hypot'):
+            engine.drivers[name] = instruments.SimHypot(latency=args.serial_latency, outcomes=outcomes, seed=args.seed + len(engine.drivers))
+        else:
+            engine.drivers[name] = instruments.SimSwitch(latency=args.serial_latency)
+        engine.drivers[name].Initialize('SIM::' + engine.hwids[name], True, False, '')
+    simLaser = instruments.SimLaserServer(latency=args.laser_latency, markTime=args.mark_time * args.time_scale,
+                                        programLoadTime=args.program_load_time * args.time_scale)
+    simLaser.start()
+    engine.connect_laser(simLaser.address)
+
+    engine.hypotSettings.update(engine.default_hypot_settings())
+    for key in ('rampuptime', 'dwelltime', 'rampdowntime'):
+        engine.hypotSettings[key] *= args.time_scale
+    engine.hypotCachePath = os.path.join(tempfile.mkdtemp(), 'hypotcache.ini')  # Never touch the fixture's cache
+    engine.settleCalPath = os.path.join(tempfile.mkdtemp(), 'settlecal.ini')
+    engine.laserPipelined = not args.no_pipeline
+    engine.scanMode = args.scan
+    engine.retestLimit = args.retests
+    engine.batchState.set_settings(dict.fromkeys(engine.cavityMap, 1), dict.fromkeys(engine.cavityMap, 1))
+
+    if args.calibrate:
+        with contextlib.redirect_stdout(io.StringIO()):
+            engine.calibrate_switches()
+    for name in phaseNames:
+        setattr(engine, name, timed_phase(name, getattr(engine, name)))
+    return simLaser
+
+
+def setup_logging(mode):
+    # Off measures the engine alone, sync and queued write a real log file the way Main.py does
+    engine.logger.propagate = False
+    engine.logger.setLevel(logging.DEBUG)
+    if mode == 'off':
+        engine.logger.addHandler(logging.NullHandler())
+        return None
+    logHandler = logging.FileHandler(os.path.join(tempfile.mkdtemp(), 'benchmark.log'))
+    listener = logqueue.setup_logging(engine.logger, logHandler, queued=mode == 'queued', echoStream=io.StringIO())
+    engine.printPolls = listener is None
+    return listener
+
+
+def round_trips(simLaser):
+    return sum(driver.roundTrips for driver in engine.drivers.values()) + simLaser.roundTrips
+
+
+def run_benchmark(args):
+    simLaser = setup_fixture(args)
+    batchTimes = []
+    batchRoundTrips = []
+    phaseCalls = {name: [] for name in phaseNames}
+    phaseTotals = {name: [] for name in phaseNames}
+    for batch in range(args.warmup + args.batches):
+        engine.reset_batch()
+        for name in phaseNames:
+            phaseTimes[name] = []
+        startRoundTrips = round_trips(simLaser)
+        startTime = time.perf_counter()
+        with contextlib.redirect_stdout(io.StringIO()):  # Engine prints every poll, keep it out of the measurement
+            engine.start()
+        batchTime = time.perf_counter() - startTime
+        if batch < args.warmup:  # First batch programs the hypot test files
+            continue
+        batchTimes.append(batchTime)
+        batchRoundTrips.append(round_trips(simLaser) - startRoundTrips)
+        for name in phaseNames:
+            phaseCalls[name].extend(phaseTimes[name])
+            phaseTotals[name].append(sum(phaseTimes[name]))
+        if args.progress:
+            print(f'Batch {batch + 1 - args.warmup}/{args.batches}: {batchTime:.3f} s', file=sys.stderr)
+    simLaser.stop()
+
+    results = {'settings': {key: value for key, value in vars(args).items() if key not in ('baseline', 'save_baseline', 'json', 'progress', 'tolerance', 'min_delta', 'config')},
+               'batch': summarize(batchTimes), 'roundtrips': summarize(batchRoundTrips), 'phases': {}}
+    for name in phaseNames:
+        results['phases'][name] = {'call': summarize(phaseCalls[name]), 'batch': summarize(phaseTotals[name])}
+    return results
+
+
+def print_results(results):
+    print(f"{'metric':<34}{'count':>8}{'mean':>10}{'p50':>10}{'p95':>10}{'p99':>10}")
+    rows = [('batch wall time (s)', results['batch']), ('serial/laser round trips per batch', results['roundtrips'])]
+    for name, phase in results['phases'].items():
+        rows.append((name + ' per call (s)', phase['call']))
+        rows.append((name + ' per batch (s)', phase['batch']))
+    for label, stats in rows:
+        print(f"{label:<34}{stats['count']:>8}{stats['mean']:>10.4f}{stats['p50']:>10.4f}{stats['p95']:>10.4f}{stats['p99']:>10.4f}")
+
+
+def compare_results(results, baseline, tolerance, minDelta):
+    # Positive change is slower / more round trips than the baseline
+    regressions = []
+    pairs = [('batch wall time', results['batch'], baseline['batch'], minDelta), ('round trips', results['roundtrips'], baseline['roundtrips'], 0)]
+    for name, phase in results['phases'].items():
+        if name in baseline['phases']:
+            pairs.append((name + ' per batch', phase['batch'], baseline['phases'][name]['batch'], minDelta))
+    print()
+    print(f"{'compared to baseline':<34}{'stat':>6}{'baseline':>12}{'current':>12}{'change':>10}")
+    for label, current, previous, labelMinDelta in pairs:
+        for stat in ('p50', 'p95'):
+            change = (current[stat] - previous[stat]) / previous[stat] * 100 if previous[stat] else 0.0
+            flag = ''
+            if change > tolerance and current[stat] - previous[stat] > labelMinDelta:  # Ignore noise on phases that only take a few ms
+                flag = '  REGRESSION'
+                regressions.append(f'{label} {stat}')
+            print(f"{label:<34}{stat:>6}{previous[stat]:>12.4f}{current[stat]:>12.4f}{change:>9.1f}%{flag}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Cycle time benchmark of the START sequence against simulated instruments')
+    parser.add_argument('--batches', type=int, default=200, help='Batches to measure')
+    parser.add_argument('--warmup', type=int, default=1, help='Batches run before measuring, the first one programs the test files')
+    parser.add_argument('--time-scale', type=float, default=0.1, help='Scale applied to ramp/dwell and mark times, 1.0 is real time')
+    parser.add_argument('--serial-latency', type=float, default=0.008, help='Seconds per hypot/switch serial round trip')
+    parser.add_argument('--laser-latency', type=float, default=0.003, help='Seconds per laser reply')
+    parser.add_argument('--mark-time', type=float, default=1.5, help='Seconds per laser mark before scaling')
+    parser.add_argument('--program-load-time', type=float, default=0.5, help='Seconds to load a different laser program before scaling')
+    parser.add_argument('--fail-rate', type=float, default=0.02, help='Fraction of cavities that fail hypot or continuity')
+    parser.add_argument('--no-pipeline', action='store_true', help='Mark inline instead of on the laser stage')
+    parser.add_argument('--calibrate', action='store_true', help='Calibrate relay settle times before measuring instead of the fixed 100 ms')
+    parser.add_argument('--retests', type=int, default=0, help='Times a failed cavity is retested at the end of the batch')
+    parser.add_argument('--scan', action='store_true', help='Run each bank as one multi-step scan file')
+    parser.add_argument('--logging', choices=('off', 'sync', 'queued'), default='off', help='Log to a temporary file synchronously or through the queued listener')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--config', default=topology.topologyPath, help='Fixture topology to simulate')
+    parser.add_argument('--json', help='Write the results to this file')
+    parser.add_argument('--save-baseline', help='Write the results as a baseline to this file')
+    parser.add_argument('--baseline', help='Compare against a baseline written by --save-baseline')
+    parser.add_argument('--tolerance', type=float, default=5.0, help='Percent slower than the baseline that counts as a regression')
+    parser.add_argument('--min-delta', type=float, default=0.005, help='Seconds a time also has to grow by to count as a regression')
+    parser.add_argument('--progress', action='store_true', help='Print each batch time to stderr')
+    args = parser.parse_args()
+
+    logListener = setup_logging(args.logging)
+    results = run_benchmark(args)
+    if logListener is not None:
+        logListener.stop()
+    print_results(results)
+    for path in (args.json, args.save_baseline):
+        if path:
+            with open(path, 'w') as resultFile:
+                json.dump(results, resultFile, indent=2)
+    if args.baseline:
+        with open(args.baseline) as baselineFile:
+            regressions = compare_results(results, json.load(baselineFile), args.tolerance, args.min_delta)
+        if regressions:
+            print(f"Regressions: {', '.join(regressions)}")
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
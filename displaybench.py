@@ -0,0 +1,85 @@
+import argparse
+import os
+import sys
+import time
+
+import hypotdisplay
+
+
+# ReadTestDisplayRaw parser check and micro-benchmark: every corpus line must parse as listed, then each line is timed
+corpusPath = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'hypotdisplay_corpus.txt')
+readingNames = ('voltage', 'current', 'resistance', 'seconds')
+
+
+def load_corpus(path):
+    # [(expected status name, step, readings, raw line)], '\r' and '\n' in a raw line are written escaped
+    corpus = []
+    with open(path, newline='') as corpusFile:
+        for line in corpusFile:
+            line = line.rstrip('\r\n')
+            if not line or line.startswith('#'):
+                continue
+            status, step, *readings, raw = line.split('\t')
+            corpus.append((status, None if step == '-' else int(step), [None if x == '-' else float(x) for x in readings],
+                           raw.replace('\\r', '\r').replace('\\n', '\n')))
+    return corpus
+
+
+def check_corpus(corpus):
+    mismatches = []
+    for status, step, readings, raw in corpus:
+        reading = hypotdisplay.parse(raw)
+        if reading.status.name != status or reading.step != step or [getattr(reading, x) for x in readingNames] != readings:
+            mismatches.append(f'{raw!r}: expected {status} step {step} {readings}, got {reading}')
+    return mismatches
+
+
+def split_parse(rawOutput):
+    # The parse read_hypot did before hypotdisplay, kept as the baseline
+    output = rawOutput.split(',')
+    status = output[2] if len(output) > 2 else ''
+    values = {}
+    for field in output[3:]:
+        field = field.strip()
+        for unit, key in {'kV': 'voltage_kv', 'mA': 'current_ma', 'ohm': 'resistance_ohm', 's': 'test_seconds'}.items():
+            if field.endswith(unit):
+                try:
+                    values[key] = float(field[:-len(unit)].lstrip('<>=T'))
+                except ValueError:
+                    pass
+                break
+    return status, values
+
+
+def time_parser(function, lines, rounds):
+    startTime = time.perf_counter()
+    for _ in range(rounds):
+        for line in lines:
+            function(line)
+    return (time.perf_counter() - startTime) / (rounds * len(lines)) * 1e9
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Check hypotdisplay.parse against the captured line corpus and time it')
+    parser.add_argument('--rounds', type=int, default=20000, help='Passes over each line set')
+    parser.add_argument('--corpus', default=corpusPath)
+    args = parser.parse_args()
+
+    corpus = load_corpus(args.corpus)
+    mismatches = check_corpus(corpus)
+    for mismatch in mismatches:
+        print(mismatch)
+    print(f'{len(corpus) - len(mismatches)}/{len(corpus)} corpus lines parsed as expected')
+
+    # Polls are mostly running states with one result at the end, the whole corpus adds the odd layouts
+    pollLines = [raw for status, step, readings, raw in corpus if status in ('RAMP_UP', 'DWELL', 'RAMP_DOWN', 'PASS')][:4]
+    print(f"{'lines':<10}{'parser':<14}{'ns/line':>10}")
+    for label, lines in (('polls', pollLines), ('corpus', [raw for status, step, readings, raw in corpus])):
+        for name, function in (('split', split_parse), ('hypotdisplay', hypotdisplay.parse)):
+            print(f'{label:<10}{name:<14}{time_parser(function, lines, args.rounds):>10.0f}')
+    if mismatches:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,1435 @@
+import configparser
+import hashlib
+import json
+import logging
+import os
+import queue
+import sys
+import time
+import uuid
+from threading import Thread, Lock, Event, Condition
+
+import serial.tools.list_ports
+
+import batchstate
+import hypotdisplay
+import instruments
+import spc
+import topology
+import tracing
+from batchstate import Result
+from hypotdisplay import Status
+
+
+# Test engine: runs the cavities on the hypots, switches and laser marker without any UI
+logger = logging.getLogger('Rotating Log')
+errors = []
+
+faultState = False
+batchState = None  # batchstate.BatchState for the topology's cavities: run/laser settings and results of the batch being run
+hypotSettings = {}
+
+# Statistical Process Control on the current and continuity resistance of each cavity's last batches, against the hypotSettings high limits
+spcWindow = 50  # Batches kept per cavity
+spcMinSamples = 10  # Readings a cavity needs before it can trend
+spcCpkLimit = 1.33  # Cpk against the high limit below this trends
+spcDriftBatches = 5  # Newest batches compared against the rest of the window...
+spcDriftSigma = 2.0  # ...a mean this many sigma closer to the high limit trends
+spcTracker = None  # spc.SpcTracker for the topology's cavities
+spcTrending = {}  # Cavity: reasons it is heading towards a limit, as of the last batch
+
+# Driver Variables
+simulateInstruments = False
+cc = None
+ARI38XXLib = None
+SC6540Lib = None
+hwids = {}  # Instrument name from the topology, e.g. 'hypot1', 'switch1': SER= hardware id
+drivers = {}  # Same keys, connected comtypes or simulated drivers
+switchStates = {}  # Switch name: frozenset of channels engaged by our last command, missing while unknown so the next disable goes out
+uiEvents = None  # Queue of (event, cavity, value) the UI drains on its own thread, None when nothing shows the batch
+
+# Fixture Topology, replaced by apply_topology from config.yaml
+cavityMap = {}  # Cavity: {'bank', 'hypot', 'switch', 'high', 'return', 'program'}
+banks = {}  # Bank: cavities in run order, every bank runs on its own thread
+driverLabels = {}  # Instrument name: label shown to operators
+instrumentLocks = {}  # Instrument name: Lock, banks that share an instrument take turns
+progressStep = 10  # Percent of the progress bar per cavity
+hypotOptionString = 'DriverSetup=BaudRate=38400, QueryInstrStatus=true'
+switchOptionString = 'Cache=false, InterchangeCheck=false, QueryInstrStatus=true, RangeCheck=false, RecordCoercions=false, Simulate=false'
+deviceIndex = {}  # SER= hardware id: COM port of every USB serial device, refreshed by the USB watcher
+deviceIndexLock = Lock()
+usbWatchInterval = 1.0  # Seconds between USB enumerations, hubs drop and re-enumerate devices
+usbWatcher = None
+batchLock = Lock()  # Held for a whole batch, the USB watcher only reconnects between batches
+driverLastUsed = {}  # Driver name: monotonic time it last finished a cavity without an error
+driverHealthInterval = 5.0  # Seconds idle after which a driver is checked with *IDN? before its next cavity
+driverRecoveryAttempts = 3  # Re-Initialize attempts when a driver fails, the hub needs a moment to re-enumerate
+driverRecoveryDelay = 2.0  # Seconds between attempts
+cavityRetries = 1  # Times a cavity is run again after its drivers were recovered
+pendingDevices = set()  # Labels of the instruments still connecting in the background
+startupReady = Event()  # Set once every instrument and the laser marker connected or failed
+
+# Laser Variables
+laserIP = '10.10.0.167'
+laserPort = 50000
+laserClient = None
+simLaser = None
+bankProgress = {}  # Cavities finished per bank, both banks step the same progress bar
+progressBase = 0  # Progress from disabled cavities, counted before the banks start
+progressLock = Lock()
+laserLock = Lock()  # Both banks share the one laser marker
+laserPipelined = True  # Mark passed cavities on a separate stage while the hypots move on
+laserDeferRetests = False  # Mark cavities waiting on a retest after all the others, off keeps marks in cavity order and waits on the retest
+laserQueue = queue.Queue()  # Cavity numbers whose result is final, drained by laser_stage
+laserConfirmed = {}  # True if the marker confirmed the mark, False if it was attempted and not confirmed
+stagedProgram = None  # Laser program already selected on the marker for the next cavity to mark
+
+# Logging
+printPolls = True  # Print hypot polls and per cavity progress from the test threads, off when the queued logging listener echoes them
+
+# Results Database
+resultsStore = None  # results.ResultsStore, set by whoever runs the engine, None keeps results in memory only
+cavityRecords = {}  # Measurements and timings per cavity for the batch being run
+tracer = tracing.Tracer()  # Spans of every phase, replaced with one that has export paths by whoever runs the engine
+
+# Hypot Test File Cache
+hypotFrequencies = ('50Hz', '60Hz')  # Frequency settings the ARI38XX type library has an enum value for
+legacyHypotFrequencies = {'0': '50Hz', '1': '60Hz'}  # Enum values older settings.ini files stored instead, same as SimARI38XXLib
+hypotCachePath = 'hypotcache.ini'  # Kept next to settings.ini, fingerprint of the hypotSettings programmed into each instrument by HWID
+hypotCache = configparser.ConfigParser()
+hypotCacheLock = Lock()  # hypotCache and its file, banks recovering their hypots write it at the same time
+hypotFilesVerified = set()  # Hypots whose stored test file was checked since they connected
+
+# Relay Settle Calibration
+settleCalPath = 'settlecal.ini'  # Kept next to settings.ini, measured settle seconds per switch HWID and high-return channel pair
+settleCal = configparser.ConfigParser()
+relaySettleDefault = 0.1  # Seconds to wait after configuring a pair that was never calibrated
+settleMarginFactor = 1.5  # Calibrated times are scaled by this...
+settleMarginMin = 0.005  # ...plus this many seconds before the hypot may start
+settleSamples = 5  # Measurements per channel pair, the slowest one is stored
+
+# Scan Mode: one multi-step file per bank, the hypot drives the SC6540 through its scanner port and switches between cavities itself
+scanMode = False
+scanFileBase = 10  # Bank n's scan file is stored as file 10 + n, file 2 stays the single cavity test
+scannerChannelCount = 10  # Channels in each step's scanner string, at least the highest channel a bank uses
+scanStepCommands = ('SS {step}', 'SAA {channels}')  # Select a step, then give it H/L/O per scanner channel
+scanResultQuery = 'RD {step}?'  # Result of a finished step, same fields as ReadTestDisplayRaw
+scanFilesVerified = set()  # (hypot, bank) whose stored scan file was checked since the hypot connected
+scanFiles = {}  # Bank: [(cavity, scanner string)] of the scan file loaded for this batch, banks without one run per cavity
+
+# Hypot Result Polling
+continuityFailureTypes = [Status.CONT_HI_LIMIT]
+hypotFailureTypes = [Status.HI_LIMIT, Status.SHORT, Status.BREAKDOWN]
+hypotEndStates = [Status.PASS] + continuityFailureTypes + hypotFailureTypes
+hypotRunningStates = [Status.RAMP_UP, Status.DWELL, Status.RAMP_DOWN, Status.DELAY]  # Display states while the test is still going
+hypotPollLead = 0.02  # Start polling this many seconds before the test is expected to end
+hypotPollMinDelay = 0.01  # First poll interval once the test should be ending
+hypotPollMaxDelay = 0.1  # Backoff cap, same as the old fixed poll interval
+hypotTimeoutMargin = 10  # Seconds past ramp+dwell before a cavity is given up on
+
+# Retest Queue
+retestLimit = 0  # Times a failed cavity is tested again at the end of the batch, 0 makes every first failure final
+retestFailureTypes = hypotFailureTypes + continuityFailureTypes  # Display states worth a retest, marginal parts rather than a dead instrument
+retestCondition = Condition()  # Guards the retest state below, bank threads wait on it for work
+retestQueue = []  # Failed cavities waiting for a retest, taken by whichever bank is idle
+retestPending = set()  # Cavities whose result isn't final until their retest ran, queued or running
+retestCounts = {}  # Cavity: retests run this batch
+retestHistory = []  # Records of the attempts a retest replaced, stored with the batch
+banksTesting = set()  # Banks still on their own cavities, their failures wait until they're done
+retestsRunning = 0
+
+
+def apply_topology(fixtureTopology):
+    global progressStep
+    global spcTracker
+    global batchState
+    cavityMap.clear()
+    cavityMap.update(fixtureTopology['cavities'])
+    banks.clear()
+    banks.update(fixtureTopology['banks'])
+    driverLabels.clear()
+    driverLabels.update(fixtureTopology['labels'])
+    instrumentLocks.clear()
+    instrumentLocks.update({name: Lock() for name in driverLabels})
+    progressStep = 100 / len(cavityMap)
+    spcTracker = spc.SpcTracker(cavityMap, spcWindow)
+    batchState = batchstate.BatchState(cavityMap)
+
+
+apply_topology(topology.build_topology(topology.defaultTopology))  # Stock fixture until the caller loads config.yaml
+
+
+def default_hypot_settings():
+    return {
+        'voltage': 1000,  # AC Voltage
+        'currenthighlimit': 10,  # Current High Limit
+        'currentlowlimit': 0.001,  # Current Low Limit
+        'rampuptime': 0.1,  # Ramp up time in seconds
+        'dwelltime': 0.3,  # RampDownTime in seconds
+        'rampdowntime': 0.0,  # Dewll time in seconds
+        'arcsenselevel': 1,  # ArcSense level
+        'arcdetection': False,  # Arc detection
+        'frequency': '60Hz',  # Frequency, 50Hz or 60Hz. Mapped to the driver's enum when the hypot is programmed, the type library loads in the background
+        'continuitytest': True,  # Continuity test
+        'highlimitresistance': 1.5,  # High limit of the continuity resistance
+        'lowlimitresistance': 0.01,  # Low limit of the continuity resistance
+        'resistanceoffset': 0.5  # Continuity resistance offset
+    }
+
+
+def hwid_serial(portHwid):
+    # 'USB VID:PID=0403:6001 SER=AQ0465JUA LOCATION=1-1' -> 'AQ0465JUA'
+    if 'SER=' not in portHwid:
+        return None
+    return portHwid.split('SER=')[1].split()[0]
+
+
+def refresh_device_index():
+    # One enumeration for every lookup, returns the hardware ids that appeared and disappeared since the last one
+    ports = serial.tools.list_ports.comports()
+    newIndex = {}
+    for port in ports:
+        serialNumber = hwid_serial(port.hwid)
+        if serialNumber:
+            newIndex[serialNumber] = port.device
+    with deviceIndexLock:
+        added = {hwid for hwid, device in newIndex.items() if deviceIndex.get(hwid) != device}
+        removed = set(deviceIndex) - set(newIndex)
+        deviceIndex.clear()
+        deviceIndex.update(newIndex)
+    for hwid in sorted(added):
+        # Print all device details for debugging purposes
+        print(f"Device: {newIndex[hwid]}, HWID: {hwid}")
+        logger.info(f"Device: {newIndex[hwid]}, HWID: {hwid}")
+    for hwid in sorted(removed):
+        print(f"Device removed, HWID: {hwid}")
+        logger.info(f"Device removed, HWID: {hwid}")
+    return added, removed
+
+
+def usb_hwids():
+    if not deviceIndex:
+        refresh_device_index()
+    with deviceIndexLock:
+        return sorted(deviceIndex)
+
+
+def find_com_port_by_hwid_number(targetHwidNumber):
+    if not targetHwidNumber:  # Not configured, an empty id would match any device
+        return None
+    if not deviceIndex:
+        refresh_device_index()
+    with deviceIndexLock:
+        device = deviceIndex.get(targetHwidNumber)
+        if device is None:  # Settings may hold part of the serial number
+            device = next((device for hwid, device in deviceIndex.items() if targetHwidNumber in hwid), None)
+    if device is not None:
+        logger.info('Hwid number: ' + targetHwidNumber + ' Located at: ' + device)
+    return device
+
+
+def concat_port(comPort):
+    try:
+        print(f'Com Port: {comPort}')
+        logger.info(f'Com Port: {comPort}')
+        print('Serial Port Alias: ASRL' + comPort.replace("COM", '') + '::INSTR')
+        logger.info('Serial Port Alias: ASRL' + comPort.replace("COM", '') + '::INSTR')
+        return 'ASRL' + comPort.replace("COM", '') + '::INSTR'
+    except Exception as ex:
+        logger.error(f'Concat port error with {comPort}: {ex}')
+        print(f'Concat port error with {comPort}: {ex}')
+        return None
+
+
+
+
+def load_driver_libraries(simulate, genDir=None):
+    global simulateInstruments
+    global cc
+    global ARI38XXLib
+    global SC6540Lib
+    simulateInstruments = simulate
+    if simulate:
+        ARI38XXLib = instruments.SimARI38XXLib
+        print('Simulating instruments')
+        logger.info('Simulating instruments')
+    else:
+        sys.coinit_flags = 0  # Multithreaded apartment, drivers are connected on startup threads and used on the bank threads
+        import comtypes.client as cc
+        import comtypes.gen
+        if genDir is not None:
+            # Keep the generated wrappers next to the exe, GetModule then imports them instead of parsing the DLLs every start
+            os.makedirs(genDir, exist_ok=True)
+            if genDir not in comtypes.gen.__path__:
+                comtypes.gen.__path__.insert(0, genDir)
+            cc.gen_dir = genDir
+        cc.GetModule('SC6540.dll')
+        from comtypes.gen import SC6540Lib
+
+        cc.GetModule('ARI38XX_64.dll')
+        from comtypes.gen import ARI38XXLib
+
+
+def find_resource(name):
+    if simulateInstruments:  # No USB devices to look up
+        return 'SIM::' + hwids[name]
+    # Avoid using COM# because windows can mix it up
+    return concat_port(find_com_port_by_hwid_number(hwids[name]))
+
+
+def connect_driver(name):
+    try:
+        portNum = find_resource(name)
+        if name.startswith('hypot'):
+            driver = instruments.create_hypot_driver(simulateInstruments, cc=cc, ARI38XXLib=ARI38XXLib)
+            driver.Initialize(portNum, True, False, hypotOptionString)
+        else:
+            driver = instruments.create_switch_driver(simulateInstruments, cc=cc, SC6540Lib=SC6540Lib)
+            driver.Initialize(portNum, True, False, switchOptionString)
+        drivers[name] = driver
+        switchStates.pop(name, None)  # Relays may be anywhere after a power cycle
+        hypotFilesVerified.discard(name)  # New connection, check its stored test files again
+        scanFilesVerified.difference_update({key for key in scanFilesVerified if key[0] == name})
+        print(f"{name.capitalize()} Port: {portNum}")
+        logger.info(f"{name.capitalize()} Port: {portNum}")
+    except Exception as e:
+        print(f'Connection to {driverLabels[name]} failed: {e}')
+        logger.error(f'Connection to {driverLabels[name]} failed: {e}')
+        errors.append(f'Connection to {driverLabels[name]} failed')
+    finally:
+        pendingDevices.discard(driverLabels[name])
+
+
+def connect_drivers():
+    for name in driverLabels:
+        connect_driver(name)
+
+
+def connect_laser(address=None):
+    global laserClient
+    global simLaser
+    if address is None:
+        if simulateInstruments:
+            if simLaser is None:
+                simLaser = instruments.SimLaserServer()
+                simLaser.start()
+            address = simLaser.address
+        else:
+            address = (laserIP, laserPort)
+    if laserClient is not None:
+        laserClient.close()
+    laserClient = instruments.LaserClient(address)  # Keeps reconnecting on its own if the marker drops later
+    if laserClient.connect():
+        clear_laser_error()
+    else:
+        print('Connection to Laser Marker failed')
+        errors.append('Connection to Laser Marker failed')
+    pendingDevices.discard('Laser Marker')
+
+
+def start_up(simulate, genDir=None):
+    # Runs off the UI thread: type libraries first, then the four instruments and the laser marker all at once
+    global usbWatcher
+    pendingDevices.update(driverLabels.values(), ['Laser Marker'])
+    startTime = time.monotonic()
+    try:
+        load_driver_libraries(simulate, genDir)
+    except Exception as ex:
+        print(f'Loading instrument drivers failed: {ex}')
+        logger.error(f'Loading instrument drivers failed: {ex}')
+        errors.append('Loading instrument drivers failed')
+        pendingDevices.clear()
+        startupReady.set()
+        return
+    if not simulate:
+        refresh_device_index()  # One enumeration shared by the four lookups
+    settleCal.read(settleCalPath)
+    connectThreads = [Thread(target=connect_driver, args=(name,), daemon=True) for name in driverLabels]
+    connectThreads.append(Thread(target=connect_laser, daemon=True))
+    for thread in connectThreads:
+        thread.start()
+    for thread in connectThreads:
+        thread.join()
+    print(f'Startup done in {time.monotonic() - startTime:.1f} s')
+    logger.info(f'Startup done in {time.monotonic() - startTime:.1f} s')
+    startupReady.set()
+    if not simulate:
+        usbWatcher = Thread(target=watch_usb, daemon=True)
+        usbWatcher.start()
+
+
+def watch_usb():
+    # Reconnects a hypot or switch as soon as it shows up again after a hub dropped it
+    disconnected = set()  # Driver names whose hardware id left the index
+    while True:
+        time.sleep(usbWatchInterval)
+        try:
+            added, removed = refresh_device_index()
+        except Exception as ex:
+            logger.error(f'USB enumeration failed: {ex}')
+            continue
+        for name, hwid in hwids.items():
+            if hwid in removed and name not in disconnected:
+                disconnected.add(name)
+                print(f'{driverLabels[name]} disconnected')
+                logger.error(f'{driverLabels[name]} disconnected')
+                errors.append(f'{driverLabels[name]} disconnected')
+            elif hwid in added:
+                disconnected.add(name)  # Back, or on a new port, either way the old handle is dead
+        if disconnected and batchLock.acquire(blocking=False):
+            try:
+                for name in sorted(disconnected):
+                    if driver_healthy(name):  # Already recovered by its bank during a batch
+                        disconnected.discard(name)
+                    elif find_com_port_by_hwid_number(hwids[name]) is not None and reconnect_driver(name):
+                        disconnected.discard(name)
+            finally:
+                batchLock.release()
+
+
+def driver_healthy(name):
+    if name not in drivers:
+        return False
+    try:
+        with tracer.span('health', instrument=name):
+            tracer.round_trips(2)
+            drivers[name].System.WriteString('*IDN?\n')
+            return bool(drivers[name].System.ReadString().strip())
+    except Exception as ex:
+        logger.error(f'{driverLabels[name]} health check failed: {ex}')
+        return False
+
+
+def recover_driver(name):
+    # Re-Initialize on the re-discovered ASRL resource, the COM port may have changed
+    for attempt in range(1, driverRecoveryAttempts + 1):
+        print(f'Recovering {driverLabels[name]}, attempt {attempt}')
+        logger.error(f'Recovering {driverLabels[name]}, attempt {attempt}')
+        if not simulateInstruments:
+            refresh_device_index()
+        if reconnect_driver(name):
+            if name.startswith('hypot'):  # A power cycled hypot may have lost its loaded test file, the caller holds its lock
+                create_hypot_test(name, hypot_settings_fingerprint())
+                write_hypot_cache()
+            return True
+        time.sleep(driverRecoveryDelay)
+    return False
+
+
+def ensure_drivers(names):
+    # Only drivers that sat idle get an extra round trip, a failure during the cavity is caught by run_cavity
+    for name in names:
+        if name in drivers and time.monotonic() - driverLastUsed.get(name, 0.0) < driverHealthInterval:
+            continue
+        if not driver_healthy(name) and not recover_driver(name):
+            raise RuntimeError(f'{driverLabels[name]} unavailable')
+
+
+def reconnect_driver(name):
+    oldDriver = drivers.pop(name, None)
+    if oldDriver is not None:
+        try:
+            oldDriver.close()
+        except Exception as ex:
+            logger.info(f'Closing old {driverLabels[name]} driver: {ex}')
+    for message in (f'{driverLabels[name]} disconnected', f'Connection to {driverLabels[name]} failed'):
+        while message in errors:
+            errors.remove(message)
+    connect_driver(name)
+    if name in drivers:
+        print(f'{driverLabels[name]} reconnected')
+        logger.info(f'{driverLabels[name]} reconnected')
+    return name in drivers
+
+
+def hypot_settings_fingerprint():
+    return hashlib.sha256(json.dumps(hypotSettings, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+def hypot_file_matches(hypotDriver, fileNum=2):
+    # Load the stored test file and spot check it, the instrument may have been edited or reset since the cache was written
+    try:
+        hypotDriver.Files.Load(fileNum)
+        return (abs(hypotDriver.Parameters.Voltage - hypotSettings['voltage']) < 1e-6
+                and abs(hypotDriver.Parameters.HighLimit - hypotSettings['currenthighlimit']) < 1e-6
+                and abs(hypotDriver.Parameters.Dwell - hypotSettings['dwelltime']) < 1e-6)
+    except Exception as ex:
+        print(f'Unable to load stored hypot test: {ex}')
+        logger.info(f'Unable to load stored hypot test: {ex}')
+        return False
+
+
+def create_hypot_tests():
+    # Between batches, no bank is using a hypot
+    fingerprint = hypot_settings_fingerprint()
+    with hypotCacheLock:
+        hypotCache.read(hypotCachePath)
+    for hypotName in [name for name in driverLabels if name.startswith('hypot')]:
+        if hypotName not in drivers:  # Not connected, programmed by recover_driver once it is
+            print(f'{driverLabels[hypotName]} not connected, skipping test file')
+            logger.error(f'{driverLabels[hypotName]} not connected, skipping test file')
+            continue
+        create_hypot_test(hypotName, fingerprint)
+    write_hypot_cache()
+
+
+def create_hypot_test(hypotName, fingerprint):
+    # One hypot's single cavity test file, the caller holds its instrumentLocks entry or runs between batches
+    hypotDriver = drivers[hypotName]
+    hypotHwid = hwids[hypotName]
+    with hypotCacheLock:
+        cachedFingerprint = hypotCache.get(hypotHwid, 'fingerprint', fallback='')
+    if cachedFingerprint == fingerprint:
+        if hypotName not in hypotFilesVerified:  # Check the instrument's stored file once per connection
+            if hypot_file_matches(hypotDriver):
+                hypotFilesVerified.add(hypotName)
+        if hypotName in hypotFilesVerified:
+            print(f'{hypotName} test file unchanged, skipping reprogram')
+            logger.info(f'{hypotName} test file unchanged, skipping reprogram')
+            return
+
+    # Create file
+    try:
+        hypotDriver.Files.Create(2, 'LHChypot')
+        print(f'Hypot test created')
+        logger.info(f'Hypot test created')
+    except Exception as ex:
+        print(f'Hypot test exists, or Issue: {ex}')
+        logger.info(f'Hypot test exists, or Issue: {ex}')
+        try:
+            hypotDriver.Files.Delete(2)
+            hypotDriver.Files.Create(2, 'LHChypot')
+        except Exception as ex:
+            logger.error(f"Error creating hypot test on {hypotName}: {ex}")
+            print(f"Error creating hypot test on {hypotName}: {ex}")
+            forget_hypot_test(hypotName)
+            return
+    finally:
+        print(f'Unable to create hypot test. ERROR')
+        logger.error(f'Unable to create hypot test. ERROR')
+
+    # Hypot manual results read on page 83
+    #   Add ACW test item by AddACWTest()
+    try:
+        hypotDriver.Steps.AddACWTestWithDefaults()
+        set_acw_parameters(hypotDriver)
+        hypotDriver.Files.Save()
+    except Exception as ex:
+        logger.error(f"Error creating hypot test on {hypotName}: {ex}")
+        print(f"Error creating hypot test on {hypotName}: {ex}")
+        forget_hypot_test(hypotName)
+        return
+
+    hypotFilesVerified.add(hypotName)
+    with hypotCacheLock:
+        if not hypotCache.has_section(hypotHwid):
+            hypotCache.add_section(hypotHwid)
+        hypotCache[hypotHwid]['fingerprint'] = fingerprint
+
+
+def forget_hypot_test(hypotName):
+    hypotFilesVerified.discard(hypotName)
+    with hypotCacheLock:
+        if hypotCache.has_section(hwids[hypotName]):
+            hypotCache.remove_section(hwids[hypotName])  # Unknown state on the instrument, reprogram next time
+
+
+def write_hypot_cache():
+    with hypotCacheLock, open(hypotCachePath, 'w') as cachefile:
+        hypotCache.write(cachefile)
+
+
+def hypot_frequency_setting(value):
+    # settings.ini frequency as '50Hz' or '60Hz', older files have the enum value
+    value = legacyHypotFrequencies.get(str(value).strip(), str(value).strip())
+    if value not in hypotFrequencies:
+        raise ValueError(f'frequency {value} is not one of {", ".join(hypotFrequencies)}')
+    return value
+
+
+def hypot_frequency(frequency):
+    # '60Hz' -> ARI38XXLib.ARI38XXFrequency60Hz of whichever type library load_driver_libraries loaded
+    if frequency not in hypotFrequencies:
+        raise ValueError(f'Hypot frequency {frequency} is not one of {", ".join(hypotFrequencies)}')
+    return getattr(ARI38XXLib, 'ARI38XXFrequency' + frequency)
+
+
+def set_acw_parameters(hypotDriver):
+    # Applies to the ACW step just added
+    hypotDriver.Parameters.Voltage = hypotSettings['voltage']
+    hypotDriver.Parameters.HighLimit = hypotSettings['currenthighlimit']
+    hypotDriver.Parameters.LowLimit = hypotSettings['currentlowlimit']
+    hypotDriver.Parameters.RampUp = hypotSettings['rampuptime']
+    hypotDriver.Parameters.Dwell = hypotSettings['dwelltime']
+    hypotDriver.Parameters.RampDown = hypotSettings['rampdowntime']
+    hypotDriver.Parameters.ArcSense = hypotSettings['arcsenselevel']
+    hypotDriver.Parameters.ArcDetectEnabled = hypotSettings['arcdetection']
+    hypotDriver.Parameters.Frequency = hypot_frequency(hypotSettings['frequency'])
+    hypotDriver.Parameters.ContinuityEnabled = hypotSettings['continuitytest']
+    hypotDriver.Parameters.ContHiLimit = hypotSettings['highlimitresistance']
+    hypotDriver.Parameters.ContLoLimit = hypotSettings['lowlimitresistance']
+    hypotDriver.Parameters.ContOffset = hypotSettings['resistanceoffset']
+
+
+def scan_steps(bankCavities):
+    # (cavity, scanner string) for every enabled cavity of a bank in run order: H on its high channel, L on its return, O elsewhere
+    channelCount = max([scannerChannelCount] + [max(cavityMap[x]['high'], cavityMap[x]['return']) for x in bankCavities])
+    steps = []
+    for cavitynum in bankCavities:
+        if batchState.runCavity[cavitynum]:
+            channels = ['O'] * channelCount
+            channels[cavityMap[cavitynum]['high'] - 1] = 'H'
+            channels[cavityMap[cavitynum]['return'] - 1] = 'L'
+            steps.append((cavitynum, ''.join(channels)))
+    return steps
+
+
+def create_scan_tests():
+    # Same caching as the single cavity file, keyed by bank since the enabled cavities decide the steps
+    loadedHypots = set()
+    for bankNum, bankCavities in banks.items():
+        hypotNames = {cavityMap[cavitynum]['hypot'] for cavitynum in bankCavities}
+        steps = scan_steps(bankCavities)
+        if len(hypotNames) > 1 or len(steps) < 2:
+            continue  # Cavities on different hypots can't share a file, one cavity gains nothing from a scan
+        hypotName = hypotNames.pop()
+        if hypotName not in hypotFilesVerified:
+            continue  # Single cavity file failed too, leave this hypot alone
+        hypotDriver = drivers[hypotName]
+        hypotHwid = hwids[hypotName]
+        fileNum = scanFileBase + bankNum
+        cacheKey = 'scan' + str(bankNum)
+        fingerprint = hashlib.sha256(json.dumps([hypotSettings, steps], sort_keys=True).encode('utf-8')).hexdigest()
+        try:
+            if hypotCache.get(hypotHwid, cacheKey, fallback='') == fingerprint:
+                if (hypotName, bankNum) not in scanFilesVerified:
+                    loadedHypots.add(hypotName)
+                    if hypot_file_matches(hypotDriver, fileNum):
+                        scanFilesVerified.add((hypotName, bankNum))
+                if (hypotName, bankNum) in scanFilesVerified:
+                    print(f'{hypotName} bank {bankNum} scan file unchanged, skipping reprogram')
+                    logger.info(f'{hypotName} bank {bankNum} scan file unchanged, skipping reprogram')
+                    scanFiles[bankNum] = steps
+                    continue
+            scanFilesVerified.discard((hypotName, bankNum))
+            loadedHypots.add(hypotName)
+            try:
+                hypotDriver.Files.Create(fileNum, 'LHCscan' + str(bankNum))
+            except Exception as ex:
+                print(f'Scan file {fileNum} exists, or Issue: {ex}')
+                logger.info(f'Scan file {fileNum} exists, or Issue: {ex}')
+                hypotDriver.Files.Delete(fileNum)
+                hypotDriver.Files.Create(fileNum, 'LHCscan' + str(bankNum))
+            for stepNum, (cavitynum, channels) in enumerate(steps, start=1):
+                hypotDriver.Steps.AddACWTestWithDefaults()
+                set_acw_parameters(hypotDriver)
+                for command in scanStepCommands:
+                    hypotDriver.System.WriteString(command.format(step=stepNum, channels=channels) + '\n')
+            hypotDriver.Files.Save()
+            print(f'{hypotName} bank {bankNum} scan file created with {len(steps)} steps')
+            logger.info(f'{hypotName} bank {bankNum} scan file created with {len(steps)} steps')
+        except Exception as ex:
+            logger.error(f'Error creating scan file on {hypotName} for bank {bankNum}: {ex}')
+            print(f'Error creating scan file on {hypotName} for bank {bankNum}: {ex}')
+            with hypotCacheLock:
+                if hypotCache.has_section(hypotHwid):
+                    hypotCache.remove_option(hypotHwid, cacheKey)  # Unknown state on the instrument, reprogram next time
+            continue
+        scanFilesVerified.add((hypotName, bankNum))
+        with hypotCacheLock:
+            if not hypotCache.has_section(hypotHwid):
+                hypotCache.add_section(hypotHwid)
+            hypotCache[hypotHwid][cacheKey] = fingerprint
+        scanFiles[bankNum] = steps
+    for hypotName in loadedHypots:
+        try:
+            drivers[hypotName].Files.Load(2)  # Anything that falls back to single cavities runs file 2
+        except Exception as ex:
+            logger.error(f'Unable to reload the single cavity test on {hypotName}: {ex}')
+            hypotFilesVerified.discard(hypotName)
+    write_hypot_cache()
+
+
+def start():
+    with batchLock:  # The USB watcher never swaps a driver in the middle of a batch
+        tracer.start_batch()
+        return run_batch()
+
+
+def run_batch():
+    with tracer.span('program'):
+        create_hypot_tests()
+        scanFiles.clear()
+        if scanMode:
+            create_scan_tests()
+    global faultState
+    global progressBase
+    global stagedProgram
+    progressBase = batchState.disabled_count() * progressStep
+    report_progress(progressBase)
+    batchStart = time.time()
+    batchState.clear_results()
+    for i in cavityMap:
+        cavityRecords[i] = {'cavity': i}
+    laserConfirmed.clear()
+    with retestCondition:
+        retestQueue.clear()
+        retestPending.clear()
+        banksTesting.clear()
+        banksTesting.update(banks)
+    retestCounts.clear()
+    retestHistory.clear()
+    stagedProgram = None  # Marker may have been used by hand since the last batch
+    while not laserQueue.empty():  # Drop anything left from an aborted batch
+        laserQueue.get()
+
+    if laserPipelined:  # Marker works through passed cavities while the hypots test the next ones
+        laserThread = Thread(target=laser_stage)
+        laserThread.start()
+
+    # Banks normally have their own hypot and switch so they all run at the same time, shared instruments take turns per cavity
+    bankThreads = []
+    for bankNum, bankCavities in banks.items():
+        bankProgress[bankNum] = 0
+        bankThread = Thread(target=run_bank, args=(bankNum, bankCavities))
+        bankThread.start()
+        bankThreads.append(bankThread)
+    for bankThread in bankThreads:
+        bankThread.join()
+    if laserPipelined:
+        laserThread.join()  # Batch is only done once every queued mark has been handled
+        if False in laserConfirmed.values():
+            print(f"Unconfirmed laser marks: {laserConfirmed}")
+            logger.error(f"Unconfirmed laser marks: {laserConfirmed}")
+            faultState = True
+
+    print(f"Continuity results: {batchState.result_map(batchState.continuity)}")
+    logger.info(f"Continuity results: {batchState.result_map(batchState.continuity)}")
+    print(f"Hypot results:      {batchState.result_map(batchState.hypot)}")
+    logger.info(f"Hypot results:      {batchState.result_map(batchState.hypot)}")
+    batchId = record_results(batchStart)
+    batchState.archive(batchId, faultState)
+    update_spc()
+    tracer.finish_batch(batchId, cavityRecords)
+    return faultState
+
+
+def record_results(batchStart):
+    # Returns the batch id the results are stored under
+    batchId = time.strftime('%Y%m%d-%H%M%S', time.localtime(batchStart)) + '-' + uuid.uuid4().hex[:6]
+    for cavitynum, record in cavityRecords.items():
+        record['hypot_code'] = batchState.hypot[cavitynum]
+        record['continuity_code'] = batchState.continuity[cavitynum]
+        if batchState.hypot[cavitynum] != Result.DISABLED:  # Disabled cavities are stored but don't count towards yield
+            record['passed'] = int(batchState.passed(cavitynum))
+    if resultsStore is not None:  # Attempts a retest replaced go in too, yield counts the last attempt
+        resultsStore.record_batch(batchId, batchStart, time.time(), faultState, retestHistory + list(cavityRecords.values()))
+    return batchId
+
+
+def update_spc():
+    # Final attempt of every cavity goes into the ring buffers, trending cavities are posted for the UI
+    with tracer.span('spc'):
+        spcTracker.add_batch(cavityRecords)
+        trending = spcTracker.evaluate(hypotSettings, spcMinSamples, spcCpkLimit, spcDriftBatches, spcDriftSigma)
+    for cavitynum in sorted(trending):
+        if cavitynum not in spcTrending:
+            print('Cavity ' + str(cavitynum) + ' trending: ' + ', '.join(trending[cavitynum]))
+            logger.info('Cavity ' + str(cavitynum) + ' trending: ' + ', '.join(trending[cavitynum]))
+    spcTrending.clear()
+    spcTrending.update(trending)
+    post_event('spc', value=trending)
+
+
+def load_spc_history():
+    # Fills the ring buffers from results.db so trends survive a restart
+    if resultsStore is None:
+        return
+    try:
+        batchRecords = resultsStore.recent_readings(spcWindow)
+    except Exception as ex:
+        logger.error(f'Error loading SPC history: {ex}')
+        return
+    for records in batchRecords:
+        spcTracker.add_batch(records)
+    spcTrending.update(spcTracker.evaluate(hypotSettings, spcMinSamples, spcCpkLimit, spcDriftBatches, spcDriftSigma))
+
+
+def reset_batch():
+    global faultState
+    faultState = False
+    disable_all_switches()
+    batchState.clear_results()
+
+
+def run_bank(bankNum, bankCavities):
+    doneCavities = set()
+    try:
+        scannedCavities = run_scan(bankNum) if bankNum in scanFiles else set()
+        for cavitynum in bankCavities:
+            if batchState.runCavity[cavitynum]:    # If cavity Enabled
+                if cavitynum not in scannedCavities:  # Anything the scan didn't finish runs on its own
+                    log_echo('Running Cavity: ' + str(cavitynum))
+                    cavityRecords[cavitynum]['started_at'] = time.time()
+                    post_event('running', cavitynum)
+                    with tracer.span('cavity', bank=bankNum, cavity=cavitynum):
+                        run_cavity(cavitynum)
+                    update_bank_progress(bankNum)
+            else: # If cavity Disabled
+                batchState.set_result(cavitynum, Result.DISABLED, Result.DISABLED)  # Dont show on fault window, but don't do other functions either
+                queue_laser_job(cavitynum)  # Still queued so the laser stage can move past it in order
+            finish_cavity(bankNum, cavitynum)
+            doneCavities.add(cavitynum)
+        for switchName in {cavityMap[cavitynum]['switch'] for cavitynum in bankCavities}:
+            try:
+                with instrumentLocks[switchName]:
+                    disable_switch(switchName)
+            except Exception as ex:
+                logger.error(f'Bank {bankNum} {driverLabels[switchName]} not cleared: {ex}')
+    finally:
+        if len(doneCavities) < len(bankCavities):  # Thread is going down, don't leave the laser stage waiting on the rest
+            abandon_cavities(bankNum, [x for x in bankCavities if x not in doneCavities])
+        with retestCondition:  # This bank's failures can be retested now, by any idle bank
+            banksTesting.discard(bankNum)
+            retestCondition.notify_all()
+    run_retests(bankNum)
+    print(f'Bank {bankNum} Done')
+    logger.info(f'Bank {bankNum} Done')
+
+
+def abandon_cavities(bankNum, cavities):
+    # Cavities a crashed bank never finished fail as instrument errors, and still go to the laser stage so it can move past them
+    global faultState
+    print(f'Bank {bankNum} stopped before Cavities {cavities}')
+    logger.error(f'Bank {bankNum} stopped before Cavities {cavities}')
+    with retestCondition:  # Nobody is left to run their retests
+        for cavitynum in cavities:
+            retestPending.discard(cavitynum)
+            if cavitynum in retestQueue:
+                retestQueue.remove(cavitynum)
+    for cavitynum in cavities:
+        if batchState.runCavity[cavitynum] and 'finished_at' not in cavityRecords[cavitynum]:
+            batchState.set_result(cavitynum, Result.FAILED, Result.FAILED)
+            cavityRecords[cavitynum]['failure_type'] = 'Instrument'
+            errors.append(f'Cavity {cavitynum} not tested, Bank {bankNum} stopped')
+            post_event('failed', cavitynum, 'Instrument')
+        queue_laser_job(cavitynum)
+    faultState = True
+
+
+def finish_cavity(bankNum, cavitynum):
+    # Inline laser and fault for a final result, a cavity waiting on its retest gets them after the retest
+    global faultState
+    if not laserPipelined and cavitynum not in retestPending:
+        if batchState.laserEnabled[cavitynum]:
+            with laserLock, tracer.span('laser', bank=bankNum, cavity=cavitynum):
+                log_echo('Lasering Cavity: ' + str(cavitynum))
+                laser(cavitynum)
+        else:
+            cavityRecords[cavitynum]['laser_outcome'] = 'disabled'
+            print('Laser Disabled. Skipping Cavity: ' + str(cavitynum))
+            logger.info('Laser Disabled. Skipping Cavity: ' + str(cavitynum))
+
+    if batchState.failed(cavitynum) and cavitynum not in retestPending:
+        print("Fault State True")
+        logger.info("Fault State True")
+        faultState = True
+
+    print(f'Bank {bankNum} done with Cavity {cavitynum}')  # Separate cavities for testing readability
+    logger.info(f'Bank {bankNum} done with Cavity {cavitynum}')
+
+
+def queue_retest(cavitynum, status):
+    # True if the failure waits for a retest instead of being final
+    with retestCondition:
+        if status not in retestFailureTypes or retestCounts.get(cavitynum, 0) >= retestLimit:
+            retestPending.discard(cavitynum)
+            return False
+        retestPending.add(cavitynum)
+        retestQueue.append(cavitynum)
+        retestCondition.notify_all()
+    return True
+
+
+def run_retests(bankNum):
+    # Takes failed cavities whose own bank finished its first pass, until nothing is queued, running or still being tested
+    global retestsRunning
+    while True:
+        with retestCondition:
+            while True:
+                ready = [x for x in retestQueue if get_bank(x) not in banksTesting]
+                if ready:
+                    cavitynum = ready[0]
+                    retestQueue.remove(cavitynum)
+                    retestsRunning += 1
+                    break
+                if not retestQueue and not banksTesting and not retestsRunning:
+                    return
+                retestCondition.wait()
+        try:
+            retest_cavity(bankNum, cavitynum)
+        finally:
+            with retestCondition:
+                retestsRunning -= 1
+                retestCondition.notify_all()
+
+
+def retest_cavity(bankNum, cavitynum):
+    retestCounts[cavitynum] = retestCounts.get(cavitynum, 0) + 1
+    record = cavityRecords[cavitynum]
+    retestHistory.append(dict(record, hypot_code=batchState.hypot[cavitynum], continuity_code=batchState.continuity[cavitynum], passed=0))
+    cavityRecords[cavitynum] = {'cavity': cavitynum, 'attempt': record.get('attempt', 1) + 1, 'started_at': time.time()}
+    print(f'Retesting Cavity {cavitynum} on Bank {bankNum}, retest {retestCounts[cavitynum]} of {retestLimit}')
+    logger.info(f'Retesting Cavity {cavitynum} on Bank {bankNum}, retest {retestCounts[cavitynum]} of {retestLimit}')
+    log_echo('Running Cavity: ' + str(cavitynum))
+    post_event('running', cavitynum)
+    with tracer.span('retest', bank=get_bank(cavitynum), cavity=cavitynum):
+        run_cavity(cavitynum)  # Every outcome goes through queue_retest, still pending if it failed with retests left
+    finish_cavity(get_bank(cavitynum), cavitynum)
+
+
+def run_scan(bankNum):
+    # One Execute for the whole bank, returns the cavities that got a final result
+    bankCavities = banks[bankNum]
+    hypotName = cavityMap[bankCavities[0]]['hypot']
+    instrumentNames = sorted({hypotName} | {cavityMap[cavitynum]['switch'] for cavitynum in bankCavities})
+    scannedCavities = set()
+    for name in instrumentNames:
+        instrumentLocks[name].acquire()
+    try:
+        ensure_drivers(instrumentNames)
+        hypotDriver = drivers[hypotName]
+        with tracer.span('scan', bank=bankNum, instrument=hypotName):
+            for name in instrumentNames:
+                if name.startswith('switch'):
+                    disable_switch(name)  # Relays belong to the hypot's scanner port until the scan is done
+                    switchStates.pop(name)  # Scanner leaves them wherever its last step did
+            tracer.round_trips(2)
+            hypotDriver.Files.Load(scanFileBase + bankNum)
+            hypotDriver.Execution.Execute()
+            try:
+                read_scan(hypotDriver, bankNum, time.monotonic(), scannedCavities)
+            finally:
+                tracer.round_trips(2)
+                hypotDriver.Execution.Abort()  # Stops the remaining steps if reading them failed
+                hypotDriver.Files.Load(2)
+        for name in instrumentNames:
+            driverLastUsed[name] = time.monotonic()
+    except Exception as ex:
+        print(f'Instrument error on Bank {bankNum} scan: {ex}')
+        logger.error(f'Instrument error on Bank {bankNum} scan: {ex}')
+        try:
+            drivers[hypotName].Files.Load(2)
+        except Exception:
+            pass  # Driver is gone, recovering it reloads the single cavity test
+        for name in instrumentNames:
+            if not driver_healthy(name):
+                recover_driver(name)
+    finally:
+        for name in instrumentNames:
+            instrumentLocks[name].release()
+    return scannedCavities
+
+
+def start_scan_steps(steps, runningStep, step):
+    # Every step up to the one on the display has started, returns how many have
+    for cavitynum, channels in steps[runningStep:step]:
+        log_echo('Running Cavity: ' + str(cavitynum))
+        cavityRecords[cavitynum].update(started_at=time.time(), attempt=1)
+        post_event('running', cavitynum)
+    return max(runningStep, min(step, len(steps)))
+
+
+def read_scan(hypotDriver, bankNum, startTime, scannedCavities):
+    # The display follows the running step, so every step before it is final and read back with RD while the next cavity tests
+    steps = scanFiles[bankNum]
+    stepTime = hypotSettings['rampuptime'] + hypotSettings['dwelltime'] + hypotSettings['rampdowntime']
+    expectedTime = stepTime * len(steps)
+    readSteps = 0
+    runningStep = 0
+    step = 1
+    pollDelay = hypotPollMinDelay
+    while True:
+        runningStep = start_scan_steps(steps, runningStep, step)
+        if readSteps == len(steps):
+            return
+        if time.monotonic() - startTime > expectedTime + hypotTimeoutMargin:
+            print(f'Bank {bankNum} scan timed out after {readSteps} steps')
+            logger.error(f'Bank {bankNum} scan timed out after {readSteps} steps')
+            return
+        nextStepEnd = startTime + (readSteps + 1) * stepTime - hypotPollLead
+        if nextStepEnd > time.monotonic():  # Nothing new until the step under test can end
+            time.sleep(nextStepEnd - time.monotonic())
+            pollDelay = hypotPollMinDelay
+        else:
+            time.sleep(pollDelay)
+            pollDelay = min(pollDelay * 2, hypotPollMaxDelay)
+
+        tracer.round_trips()
+        rawOutput = hypotDriver.Execution.ReadTestDisplayRaw()
+        reading = hypotdisplay.parse(rawOutput)
+        status = reading.status
+        if reading.step is not None:
+            step = reading.step
+        finalStep = min(step if status in hypotEndStates else step - 1, len(steps))
+        runningStep = start_scan_steps(steps, runningStep, step)  # A poll can skip a whole step, its start is still logged before its result
+        stopped = False
+        if status in hypotEndStates and step < len(steps):
+            # Between steps, or the instrument stopped on a failure and the rest of the bank runs on its own
+            tracer.round_trips(2)
+            hypotDriver.System.WriteString('*OPC?\n')
+            stopped = '1' in hypotDriver.System.ReadString()
+        if printPolls:
+            print(rawOutput)
+        logger.info('Raw Output: ' + rawOutput, extra={'echo': True, 'rateKey': 'scan' + str(bankNum), 'rateFinal': finalStep == len(steps)})
+
+        while readSteps < finalStep:
+            cavitynum = steps[readSteps][0]
+            tracer.round_trips(2)
+            hypotDriver.System.WriteString(scanResultQuery.format(step=readSteps + 1) + '\n')
+            stepOutput = hypotDriver.System.ReadString().strip()
+            stepReading = hypotdisplay.parse(stepOutput)
+            if stepReading.status not in hypotEndStates:
+                print(f'No result for step {readSteps + 1} of Bank {bankNum}: {stepOutput}')
+                logger.error(f'No result for step {readSteps + 1} of Bank {bankNum}: {stepOutput}')
+                return
+            logger.info('Raw Output: ' + stepOutput, extra={'echo': True})
+            cavityRecords[cavitynum]['raw_output'] = stepOutput
+            record_hypot_result(cavitynum, stepReading)
+            scannedCavities.add(cavitynum)
+            update_bank_progress(bankNum)
+            readSteps += 1
+        if stopped:
+            return
+
+
+def run_cavity(cavitynum):
+    # A USB drop mid cavity recovers the cavity's drivers and runs it again, the other banks keep going
+    instrumentNames = sorted({cavityMap[cavitynum]['switch'], cavityMap[cavitynum]['hypot']})  # Sorted so shared locks can't deadlock
+    switchName = cavityMap[cavitynum]['switch']
+    firstAttempt = cavityRecords[cavitynum].get('attempt', 1)  # Retests carry on counting
+    for attempt in range(firstAttempt, firstAttempt + cavityRetries + 1):
+        cavityRecords[cavitynum]['attempt'] = attempt
+        for name in instrumentNames:
+            instrumentLocks[name].acquire()
+        try:
+            ensure_drivers(instrumentNames)
+            disable_switch(switchName)  # Only goes out if the last cavity didn't leave it open
+
+            hypot_setup(cavitynum)
+            hypot_execution(cavityNum=cavitynum)
+
+            disable_switch(switchName)
+            for name in instrumentNames:
+                driverLastUsed[name] = time.monotonic()
+            return
+        except Exception as ex:
+            print(f'Instrument error on Cavity {cavitynum}: {ex}')
+            logger.error(f'Instrument error on Cavity {cavitynum}: {ex}')
+            switchStates.pop(switchName, None)  # Force the next disable whatever the switch last took
+            try:
+                disable_switch(switchName, force=True)  # Safe state before anything else, the relays may still be on the hypot
+            except Exception as switchEx:
+                print(f'Unable to open {driverLabels[switchName]} relays: {switchEx}')
+                logger.error(f'Unable to open {driverLabels[switchName]} relays: {switchEx}')
+            for name in instrumentNames:
+                try:
+                    if not driver_healthy(name):
+                        recover_driver(name)
+                except Exception as recoverEx:  # Try the next attempt anyway, ensure_drivers gives up on it if it's still gone
+                    print(f'Unable to recover {driverLabels[name]}: {recoverEx}')
+                    logger.error(f'Unable to recover {driverLabels[name]}: {recoverEx}')
+            if 'finished_at' in cavityRecords[cavitynum]:  # Result was already in, only the cleanup failed
+                return
+        finally:
+            for name in instrumentNames:
+                instrumentLocks[name].release()
+    errors.append(f'Cavity {cavitynum} not tested, instrument error')
+    post_event('failed', cavitynum, 'Instrument')
+    cavityRecords[cavitynum]['failure_type'] = 'Instrument'
+    queue_retest(cavitynum, 'Instrument')
+    queue_laser_job(cavitynum)  # No result, the laser stage will skip it as failed
+
+
+def queue_laser_job(cavitynum):
+    if laserPipelined:
+        laserQueue.put(cavitynum)
+
+
+def laser_stage():
+    finishedCavities = set()  # Cavities that came off the queue before it was their turn
+    deferredCavities = []  # Failed cavities waiting on a retest, marked once the others are done
+    for cavitynum in cavityMap:  # Marking follows the cavity order, whichever bank finishes first
+        if batchState.laserEnabled[cavitynum] and batchState.runCavity[cavitynum] and cavitynum not in finishedCavities:
+            with tracer.span('laser stage', bank=get_bank(cavitynum), cavity=cavitynum):
+                stage_laser_program(cavitynum)  # Load the program while the cavity is still under hypot
+        with tracer.span('laser wait', bank=get_bank(cavitynum), cavity=cavitynum):  # Marker idle until the hypot result is in
+            while cavitynum not in finishedCavities:
+                finishedCavities.add(laserQueue.get())
+            while cavitynum in retestPending and not laserDeferRetests:  # Operator matches parts to fixtures by mark order
+                finishedCavities.add(laserQueue.get())  # Every finished retest is queued again
+        if cavitynum in retestPending:
+            deferredCavities.append(cavitynum)
+            continue
+        mark_cavity(cavitynum)
+    for cavitynum in deferredCavities:
+        with tracer.span('laser wait', bank=get_bank(cavitynum), cavity=cavitynum):
+            while cavitynum in retestPending:
+                laserQueue.get()  # Every finished retest is queued again
+        mark_cavity(cavitynum)
+    print('Laser Stage Done')
+    logger.info('Laser Stage Done')
+
+
+def mark_cavity(cavitynum):
+    if batchState.laserEnabled[cavitynum]:
+        log_echo('Lasering Cavity: ' + str(cavitynum))
+        with tracer.span('laser', bank=get_bank(cavitynum), cavity=cavitynum):
+            laser(cavitynum)
+    else:
+        cavityRecords[cavitynum]['laser_outcome'] = 'disabled'
+        print('Laser Disabled. Skipping Cavity: ' + str(cavitynum))
+        logger.info('Laser Disabled. Skipping Cavity: ' + str(cavitynum))
+
+
+def update_bank_progress(bankNum):
+    with progressLock:  # Both bank threads report here, keep the bar in step with the total
+        bankProgress[bankNum] += 1
+        totalProgress = progressBase + sum(bankProgress.values()) * progressStep
+        logger.info(f'Bank {bankNum} progress: {bankProgress[bankNum]} cavities, total {totalProgress:.0f} %')
+        report_progress(totalProgress)
+
+
+def report_progress(value):
+    post_event('progress', value=value)
+
+
+def log_echo(message):
+    # Per cavity progress lines, printed by the queued listener instead of the test thread when there is one
+    if printPolls:
+        print(message)
+    logger.info(message, extra={'echo': True})
+
+
+def post_event(event, cavity=None, value=None):
+    # running, passed, failed, lasering, marked, laser failed, progress. Never touches the UI from the test threads
+    if uiEvents is not None:
+        uiEvents.put((event, cavity, value))
+
+
+def get_bank(cavitynum):
+    return cavityMap[cavitynum]['bank']
+
+
+def get_cavity_switch(cavitynum):
+    return drivers[cavityMap[cavitynum]['switch']]
+
+
+def get_cavity_hypot(cavitynum):
+    return drivers[cavityMap[cavitynum]['hypot']]
+
+
+def disable_all_switches():
+    # Safe state for reset and emergency stop, always sent whatever the cached state says
+    for name in drivers:
+        if name.startswith('switch'):
+            disable_switch(name, force=True)
+
+
+def disable_switch(name, force=False):
+    # Skips the command when the relays are already known to be open
+    if not force and switchStates.get(name) == frozenset():
+        return
+    switchStates.pop(name, None)  # Unknown until the switch took the command
+    with tracer.span('switch', instrument=name):
+        tracer.round_trips()
+        drivers[name].Execution.DisableAllChannels()
+    switchStates[name] = frozenset()
+
+
+def engage_channels(name, highChannel, rtnChannel):
+    # Returns False if the switch already had exactly these channels engaged
+    channels = frozenset({highChannel, rtnChannel})
+    if switchStates.get(name) == channels:
+        return False
+    if switchStates.get(name) != frozenset():  # Configuring only adds channels, anything else engaged has to open first
+        disable_switch(name)
+    switchStates.pop(name, None)
+    with tracer.span('switch', instrument=name):
+        tracer.round_trips(2)
+        drivers[name].Execution.ConfigureWithstandChannels({highChannel})
+        drivers[name].Execution.ConfigureReturnChannels({rtnChannel})
+    switchStates[name] = channels
+    return True
+
+
+def close_drivers():
+    for driver in drivers.values():
+        driver.close()
+    if laserClient is not None:
+        laserClient.close()
+
+
+def settle_time(switchName, highChannel, rtnChannel):
+    measured = settleCal.getfloat(hwids.get(switchName, ''), f'{highChannel}-{rtnChannel}', fallback=None)
+    if measured is None:
+        return relaySettleDefault
+    return measured * settleMarginFactor + settleMarginMin
+
+
+def calibrate_switches():
+    # Measures every cavity's channel pair on its switch with the hypot output off. Returns an error string, None once stored
+    if not batchLock.acquire(blocking=False):
+        return 'Batch running, calibrate between batches'
+    error = None
+    try:
+        settleCal.read(settleCalPath)
+        for switchName in [name for name in driverLabels if name.startswith('switch')]:
+            switchHwid = hwids[switchName]
+            with instrumentLocks[switchName]:
+                try:
+                    ensure_drivers([switchName])
+                    disable_switch(switchName, force=True)
+                    idleTime = min(opc_time(switchName) for sample in range(settleSamples))  # Round trip with nothing switching
+                    if not settleCal.has_section(switchHwid):
+                        settleCal.add_section(switchHwid)
+                    for cavitynum in [x for x in cavityMap if cavityMap[x]['switch'] == switchName]:
+                        highChannel = cavityMap[cavitynum]['high']
+                        rtnChannel = cavityMap[cavitynum]['return']
+                        samples = []
+                        for sample in range(settleSamples):
+                            disable_switch(switchName)
+                            opc_time(switchName)  # Let the opening relays finish, the batch opens them a whole test earlier
+                            engage_channels(switchName, highChannel, rtnChannel)
+                            samples.append(max(0.0, opc_time(switchName) - idleTime))
+                        settleCal[switchHwid][f'{highChannel}-{rtnChannel}'] = f'{max(samples):.4f}'
+                        print(f'Cavity {cavitynum} relays settle in {max(samples) * 1000:.1f} ms')
+                        logger.info(f'Cavity {cavitynum} relays settle in {max(samples) * 1000:.1f} ms on {driverLabels[switchName]}')
+                    disable_switch(switchName)
+                except Exception as ex:
+                    print(f'Calibrating {driverLabels[switchName]} failed: {ex}')
+                    logger.error(f'Calibrating {driverLabels[switchName]} failed: {ex}')
+                    switchStates.pop(switchName, None)
+                    error = f'Calibrating {driverLabels[switchName]} failed'  # Keep the other switches' results
+        with open(settleCalPath, 'w') as calfile:
+            settleCal.write(calfile)
+        return error
+    finally:
+        batchLock.release()
+
+
+def opc_time(switchName):
+    # *OPC? only answers once the switch finished switching its relays
+    startTime = time.perf_counter()
+    drivers[switchName].System.WriteString('*OPC?\n')
+    drivers[switchName].System.ReadString()
+    return time.perf_counter() - startTime
+
+
+def hypot_setup(cavitynum):
+    # Enable Return (Low) channels, wiring comes from the topology
+    rtnChannel = cavityMap[cavitynum]['return']
+    highChannel = cavityMap[cavitynum]['high']
+
+    if engage_channels(cavityMap[cavitynum]['switch'], highChannel, rtnChannel):
+        # After the multiplexer was configured, the safety tester could start output for withstand test on those connections.
+        with tracer.span('settle', instrument=cavityMap[cavitynum]['switch']):
+            time.sleep(settle_time(cavityMap[cavitynum]['switch'], highChannel, rtnChannel))
+
+    log_echo('Hypot Setup Done')
+
+
+def hypot_execution(cavityNum):
+    hypotDriver = get_cavity_hypot(cavityNum)
+    hypotName = cavityMap[cavityNum]['hypot']
+
+    try:
+        # Start test
+        with tracer.span('execute', instrument=hypotName):
+            tracer.round_trips()
+            hypotDriver.Execution.Execute()
+        executeTime = time.monotonic()
+        # Output Results
+        with tracer.span('poll', instrument=hypotName):
+            read_hypot(hypotDriver=hypotDriver, cavityNum=cavityNum, startTime=executeTime)
+    except Exception as ex:
+        logger.error('Exception occured at Hypot execution: ' + str(ex))
+        print('Exception occured at Hypot execution: ' + str(ex))
+        try:
+            hypotDriver.Execution.Abort()
+        except Exception:
+            pass  # Driver is gone, run_cavity recovers it
+        raise
+
+    with tracer.span('abort', instrument=hypotName):
+        tracer.round_trips()
+        hypotDriver.Execution.Abort()
+    log_echo('Hypot Execution Done')
+
+
+def read_hypot(hypotDriver, cavityNum, startTime):
+    global faultState
+    # The test cannot end before ramp up + dwell + ramp down, so wait that out instead of polling through it
+    expectedTime = hypotSettings['rampuptime'] + hypotSettings['dwelltime'] + hypotSettings['rampdowntime']
+    time.sleep(max(0.0, startTime + expectedTime - hypotPollLead - time.monotonic()))
+    pollDelay = hypotPollMinDelay
+    while (True):
+        tracer.round_trips()
+        rawOutput = hypotDriver.Execution.ReadTestDisplayRaw()  # One serial round trip per poll
+        reading = hypotdisplay.parse(rawOutput)
+        status = reading.status
+        cavityRecords[cavityNum]['raw_output'] = rawOutput
+
+        if status is Status.UNKNOWN:
+            # Display state this program doesn't know, only trust it once the instrument reports the operation complete
+            tracer.round_trips(2)
+            hypotDriver.System.WriteString('*OPC?\n')
+            testComplete = '1' in hypotDriver.System.ReadString()
+        else:
+            testComplete = status in hypotEndStates
+
+        if printPolls:
+            print(rawOutput)
+        # Polls are rate limited per cavity by the queued logging listener, the final reading is always logged
+        logger.info('Raw Output: ' + rawOutput, extra={'echo': True, 'rateKey': 'poll' + str(cavityNum), 'rateFinal': testComplete})
+
+        if testComplete:
+            record_hypot_result(cavityNum, reading)
+            break
+        if time.monotonic() - startTime > expectedTime + hypotTimeoutMargin:
+            print('Cavity ' + str(cavityNum) + ' hypot result timed out')
+            logger.error('Cavity ' + str(cavityNum) + ' hypot result timed out')
+            errors.append('Hypot result timed out on Cavity ' + str(cavityNum))
+            cavityRecords[cavityNum].update(failure_type='Timeout', finished_at=time.time())
+            post_event('failed', cavityNum, 'Timeout')
+            faultState = faultState or not queue_retest(cavityNum, 'Timeout')
+            queue_laser_job(cavityNum)
+            break
+        time.sleep(pollDelay)
+        pollDelay = min(pollDelay * 2, hypotPollMaxDelay)  # Tight right at the expected end, backs off if it runs long
+
+
+def record_hypot_result(cavityNum, reading):
+    global faultState
+    status = reading.status
+    cavityRecords[cavityNum].update(reading.values(), finished_at=time.time())
+    if status is not Status.PASS:
+        cavityRecords[cavityNum]['failure_type'] = reading.statusText.strip()
+    retest = queue_retest(cavityNum, status)
+    # Successes
+    if status is Status.PASS:
+        batchState.set_result(cavityNum, Result.PASSED, Result.PASSED)
+        post_event('passed', cavityNum)
+        print('Cavity ' + str(cavityNum) + ' passes hypot & continuity')
+        logger.info('Cavity ' + str(cavityNum) + ' passes hypot & continuity')
+    elif status in continuityFailureTypes:
+        batchState.set_result(cavityNum, Result.SKIPPED, Result.FAILED)
+        post_event('failed', cavityNum, 'Continuity')
+        print('Cavity ' + str(cavityNum) + ' fails Continuity')
+        logger.info('Cavity ' + str(cavityNum) + ' fails Continuity')
+        faultState = faultState or not retest
+    elif status in hypotFailureTypes:
+        batchState.set_result(cavityNum, Result.FAILED, Result.PASSED)
+        post_event('failed', cavityNum, 'Hypot')
+        print('Cavity ' + str(cavityNum) + ' fails Hypot')
+        logger.info('Cavity ' + str(cavityNum) + ' fails Hypot')
+        faultState = faultState or not retest
+    else:
+        batchState.set_result(cavityNum, Result.FAILED, Result.FAILED)
+        post_event('failed', cavityNum, 'Unknown')
+        print('Cavity ' + str(cavityNum) + ' ended on unknown hypot status ' + reading.statusText)
+        logger.error('Cavity ' + str(cavityNum) + ' ended on unknown hypot status ' + reading.statusText)
+        errors.append('Unknown hypot status ' + reading.statusText + ' on Cavity ' + str(cavityNum))
+        faultState = True
+    if retest:
+        print('Cavity ' + str(cavityNum) + ' queued for retest')
+        logger.info('Cavity ' + str(cavityNum) + ' queued for retest')
+    queue_laser_job(cavityNum)  # Result is final, hand marking off to the laser stage
+
+
+def stage_laser_program(cavityNum):
+    global stagedProgram
+    programNum = cavityMap[cavityNum]['program']  # Laser programs array starts at 0
+    if not laser_reply_ok(send_laser('RX,Ready\r')):  # Nothing is sent to a marker that isn't ready
+        stagedProgram = None
+        return
+    if send_laser('WX,ProgramNo='+str(programNum)+'\r').strip() == 'WX,OK':
+        stagedProgram = programNum
+        print('Laser program staged for Cavity: ' + str(cavityNum))
+        logger.info('Laser program staged for Cavity: ' + str(cavityNum))
+    else:
+        stagedProgram = None  # laser() falls back to selecting the program itself
+
+
+def laser(cavityNum):
+    global stagedProgram
+    programNum = cavityMap[cavityNum]['program']  # Laser programs array starts at 0
+    if batchState.passed(cavityNum):  # Only Laser if passes both tests
+        laserConfirmed[cavityNum] = False
+        outputs = None
+        post_event('lasering', cavityNum)
+        if stagedProgram == programNum:  # Already loaded while the hypot ran, only the mark is left
+            outputs = ['WX,OK'] + send_laser_commands(['WX,StartMarking\r', 'RX,ProgramNo\r'])
+        elif laser_reply_ok(send_laser('RX,Ready\r')):  # A malformed reply counts as not ready
+            programSetOutput = send_laser('WX,ProgramNo='+str(programNum)+'\r')
+            if programSetOutput.strip() == 'WX,OK':  # A rejected program would mark with whatever was loaded before
+                outputs = [programSetOutput] + send_laser_commands(['WX,StartMarking\r', 'RX,ProgramNo\r'])
+            else:
+                cavityRecords[cavityNum]['laser_outcome'] = 'program rejected'
+                post_event('laser failed', cavityNum)
+                print('Laser program ' + str(programNum) + ' not accepted on Cavity: ' + str(cavityNum))
+                logger.error('Laser program ' + str(programNum) + ' not accepted on Cavity: ' + str(cavityNum) + ', ' + programSetOutput.strip())
+        else:
+            cavityRecords[cavityNum]['laser_outcome'] = 'not ready'
+            post_event('laser failed', cavityNum)
+            print('Laser not ready, skipping')
+            logger.info('Laser not ready, skipping')
+        if outputs is not None:
+            programSetOutput, markingOutput, programOutput = outputs
+            # Marker answers WX,OK for the program and the mark, then RX,OK,<program> for the program it marked with
+            laserConfirmed[cavityNum] = (programSetOutput.strip() == 'WX,OK' and markingOutput.strip() == 'WX,OK'
+                                         and programOutput.strip() == 'RX,OK,' + str(programNum))
+            cavityRecords[cavityNum]['laser_outcome'] = 'confirmed' if laserConfirmed[cavityNum] else 'unconfirmed'
+            post_event('marked' if laserConfirmed[cavityNum] else 'laser failed', cavityNum)
+            if not laserConfirmed[cavityNum]:
+                print('Laser marking not confirmed on Cavity: ' + str(cavityNum))
+                logger.error('Laser marking not confirmed on Cavity: ' + str(cavityNum))
+    else:
+        if stagedProgram == programNum:  # Nothing to mark, the next cavity's program replaces it
+            print('Cancelling staged laser program for Cavity: ' + str(cavityNum))
+            logger.info('Cancelling staged laser program for Cavity: ' + str(cavityNum))
+        cavityRecords[cavityNum]['laser_outcome'] = 'skipped'
+        print('Skipping Laser due to failed cont or hypot')
+        logger.info('Skipping Laser due to failed cont or hypot')
+    stagedProgram = None
+
+    log_echo('Laser Done')
+
+
+def laser_reply_ok(reply):
+    # 'RX,OK,...', a truncated, empty or error reply has no OK field and isn't ready
+    parts = reply.strip().split(',')
+    return len(parts) > 1 and parts[1] == 'OK'
+
+
+def send_laser(msg):
+    return send_laser_commands([msg])[0]
+
+
+def send_laser_commands(msgs):
+    # Commands go out together and the replies come back in order, no wait between each one
+    log_echo(f'Sending to laser: {msgs}')
+    with tracer.span('laser command', instrument='laser'):
+        tracer.round_trips(len(msgs))
+        responses = laserClient.commands(msgs)
+    log_echo(f'Laser Output: {responses}')
+    if 'ng,ng,ng' in responses:
+        logger.error('Issue communicating with Laser Marker')
+    else:
+        clear_laser_error()  # LaserClient reconnected on its own since start up
+    return responses
+
+
+def clear_laser_error():
+    while 'Connection to Laser Marker failed' in errors:
+        errors.remove('Connection to Laser Marker failed')
@@ -0,0 +1,327 @@
+import argparse
+import configparser
+import contextlib
+import hmac
+import ipaddress
+import json
+import logging
+import os
+import queue
+import sys
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from logging.handlers import TimedRotatingFileHandler
+from threading import Event, Thread, Lock
+
+import engine
+import logqueue
+import results
+import topology
+import tracing
+
+
+# Headless runner: the same engine as Main.py driven by a local HTTP API or a single CLI batch, for the MES and PLC
+logger = logging.getLogger('Rotating Log')
+heartbeatInterval = 10.0  # Seconds between heartbeat lines on an idle event stream
+historyLength = 10  # Past batches listed in /status
+apiToken = None  # Bearer token POST requests must carry, required to serve on anything but loopback
+settingsPath = None  # settings.ini the per cavity settings are read back from before each API batch
+
+cavityStates = {}  # Cavity: (event, value) of the newest engine event, same events the UI draws
+progress = 0
+lastFault = None  # Fault state of the last finished batch, None before the first one
+batchRunning = False
+subscribers = []  # One queue per /events client
+stateLock = Lock()
+batchDone = Event()  # Set once the dispatcher has handled a batch's 'done' event
+
+
+def load_settings(path, simulate=False):
+    # Same settings.ini Main.py writes, missing values keep the engine defaults
+    global settingsPath
+    settingsPath = path
+    config = configparser.ConfigParser()
+    config.read(path)
+    load_cavity_settings(config)
+    engine.laserPipelined = config.getboolean('Laser', 'pipelined', fallback=True)
+    engine.laserDeferRetests = config.getboolean('Laser', 'deferretests', fallback=False)
+    engine.scanMode = config.getboolean('Hypot', 'scanmode', fallback=False)
+    engine.retestLimit = config.getint('Hypot', 'retests', fallback=0)
+    engine.hypotSettings.update(engine.default_hypot_settings())
+    for key, defaultValue in engine.default_hypot_settings().items():
+        try:
+            if isinstance(defaultValue, bool):
+                engine.hypotSettings[key] = config.getboolean('Hypot', key, fallback=defaultValue)
+            elif isinstance(defaultValue, int):  # Written as 11.0 by older versions
+                engine.hypotSettings[key] = int(config.getfloat('Hypot', key, fallback=defaultValue))
+            elif isinstance(defaultValue, float):
+                engine.hypotSettings[key] = config.getfloat('Hypot', key, fallback=defaultValue)
+            elif key == 'frequency':
+                engine.hypotSettings[key] = engine.hypot_frequency_setting(config.get('Hypot', key, fallback=defaultValue))
+        except ValueError as ex:
+            engine.hypotSettings[key] = defaultValue
+            print(f'Hypot setting {key} in {path} ignored: {ex}')
+            logger.error(f'Hypot setting {key} in {path} ignored: {ex}')
+    for name in engine.driverLabels:
+        # Unset fails its connection instead of guessing a port
+        engine.hwids[name] = config.get('Hardware IDs', name, fallback='SIM' + name.upper() if simulate else '')
+
+
+def load_cavity_settings(config):
+    engine.batchState.set_settings({x: config.getint('Run Cavity', 'cavity' + str(x), fallback=1) for x in engine.cavityMap},
+                                   {x: config.getint('Laser Enabled', 'cavity' + str(x), fallback=1) for x in engine.cavityMap})
+
+
+def setup_logging(echoStream=None):
+    logDir = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'logs')
+    os.makedirs(logDir, exist_ok=True)
+    handler = TimedRotatingFileHandler(filename=os.path.join(logDir, 'LaserHypotCont.log'), when='h', interval=8, backupCount=30)
+    handler.suffix = "%Y-%m-%d_%H-%M-%S.log"
+    logger.setLevel(logging.DEBUG)
+    listener = logqueue.setup_logging(logger, handler, queued=True, echoStream=echoStream)
+    engine.printPolls = False
+    return listener
+
+
+def status():
+    with stateLock:
+        return {'ready': engine.startupReady.is_set(), 'running': batchRunning, 'progress': progress, 'fault': lastFault,
+                'errors': list(engine.errors), 'connecting': sorted(engine.pendingDevices.copy()),
+                'cavities': {str(x): cavity_status(x) for x in engine.cavityMap},
+                'trending': {str(x): reasons for x, reasons in engine.spcTrending.items()},
+                'history': [batch_summary(x) for x in engine.batchState.recent(historyLength)]}
+
+
+def batch_summary(pastBatch):
+    return {'batchId': pastBatch.batchId, 'fault': pastBatch.fault, 'passed': [x for x in engine.cavityMap if pastBatch.passed(x)]}
+
+
+def cavity_status(cavitynum):
+    event, value = cavityStates.get(cavitynum, (None, None))
+    batchState = engine.batchState
+    return {'runCavity': batchState.runCavity[cavitynum], 'laserEnabled': batchState.laserEnabled[cavitynum],
+            'state': event, 'detail': value, 'hypot': batchState.hypot[cavitynum],
+            'continuity': batchState.continuity[cavitynum], 'laserConfirmed': engine.laserConfirmed.get(cavitynum)}
+
+
+def publish(message):
+    with stateLock:
+        for subscriber in subscribers:
+            subscriber.put(message)
+
+
+def dispatch_events():
+    # Only consumer of engine.uiEvents, keeps the status current and fans every event out to the streams
+    global progress
+    while True:
+        event, cavity, value = engine.uiEvents.get()
+        with stateLock:
+            if event == 'progress':
+                progress = value
+            elif cavity is not None:
+                cavityStates[cavity] = (event, value)
+        message = {'event': event, 'cavity': cavity, 'value': value, 'time': time.time()}
+        if event == 'done':  # Full results with the end of the batch
+            message['status'] = status()
+        publish(message)
+        if event == 'done':
+            batchDone.set()
+
+
+def start_batch(runCavity=None, laserEnabled=None):
+    # Returns an error string if a batch can't start, None once it is running
+    global batchRunning
+    with stateLock:
+        if not engine.startupReady.is_set():
+            return 'Instruments still connecting'
+        if batchRunning:
+            return 'Batch already running'
+        batchRunning = True
+        cavityStates.clear()
+    config = configparser.ConfigParser()
+    config.read(settingsPath)
+    load_cavity_settings(config)  # Overrides only last for the batch they came with
+    engine.batchState.set_settings(cavity_settings(runCavity), cavity_settings(laserEnabled))
+    Thread(target=run_batch, daemon=True).start()
+    return None
+
+
+def cavity_settings(settings):
+    # API bodies use the settings.ini keys, {'cavity3': 0}
+    cavityKeys = {'cavity' + str(x): x for x in engine.cavityMap}
+    return {cavityKeys[key]: value for key, value in (settings or {}).items() if key in cavityKeys}
+
+
+def run_batch():
+    global batchRunning
+    global lastFault
+    try:
+        faultState = engine.start()
+    except Exception as ex:
+        logger.error(f'Batch stopped by an error: {ex}')
+        engine.errors.append(f'Batch stopped by an error: {ex}')
+        faultState = True
+    with stateLock:
+        lastFault = faultState
+        batchRunning = False
+    engine.post_event('done', value=faultState)  # Behind every event of the batch on the same queue
+
+
+class ApiHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'  # Keep-alive, the PLC gateway reuses one connection
+
+    def do_GET(self):
+        if self.path == '/status':
+            self.send_json(200, status())
+        elif self.path == '/events':
+            self.stream_events()
+        else:
+            self.send_json(404, {'error': 'Unknown path'})
+
+    def do_POST(self):
+        if not self.authorized():
+            self.close_connection = True  # Body left unread
+            self.send_json(401, {'error': 'Missing or wrong API token'})
+            return
+        body = self.read_json()
+        if body is None:
+            self.send_json(400, {'error': 'Body is not JSON'})
+        elif self.path == '/start':
+            error = start_batch(body.get('runCavity'), body.get('laserEnabled'))
+            if error:
+                self.send_json(409, {'error': error})
+            else:
+                self.send_json(202, {'started': True})
+        elif self.path == '/calibrate':
+            error = engine.calibrate_switches()  # Answers once every switch is measured
+            if error:
+                self.send_json(409, {'error': error})
+            else:
+                self.send_json(200, {'calibrated': True})
+        elif self.path == '/reset':
+            with stateLock:  # Held until the reset is done so /start can't slip in
+                running = batchRunning
+                if not running:
+                    engine.reset_batch()
+            if running:
+                self.send_json(409, {'error': 'Batch already running'})
+            else:
+                self.send_json(200, status())
+        else:
+            self.send_json(404, {'error': 'Unknown path'})
+
+    def authorized(self):
+        if apiToken is None:
+            return True
+        return hmac.compare_digest(self.headers.get('Authorization', ''), 'Bearer ' + apiToken)
+
+    def read_json(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        if not length:
+            return {}
+        try:
+            body = json.loads(self.rfile.read(length))
+        except ValueError:
+            return None
+        return body if isinstance(body, dict) else None
+
+    def send_json(self, code, payload):
+        data = json.dumps(payload).encode()
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def stream_events(self):
+        # One JSON object per line until the client goes away
+        subscriber = queue.Queue()
+        with stateLock:
+            subscribers.append(subscriber)
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/x-ndjson')
+        self.send_header('Connection', 'close')
+        self.end_headers()
+        self.close_connection = True
+        try:
+            while True:
+                try:
+                    message = subscriber.get(timeout=heartbeatInterval)
+                except queue.Empty:
+                    message = {'event': 'heartbeat', 'time': time.time()}
+                self.wfile.write(json.dumps(message).encode() + b'\n')
+                self.wfile.flush()
+        except OSError:
+            pass
+        finally:
+            with stateLock:
+                subscribers.remove(subscriber)
+
+    def log_message(self, format, *args):
+        logger.info('API ' + self.address_string() + ' ' + format % args)
+
+
+def is_loopback(host):
+    if host == 'localhost':
+        return True
+    try:
+        return ipaddress.ip_address(host).is_loopback
+    except ValueError:  # Host name, may resolve to anything
+        return False
+
+
+def main():
+    global apiToken
+    parser = argparse.ArgumentParser(description='Run the laser/hypot/continuity fixture without the UI')
+    parser.add_argument('--simulate', action='store_true', help='Use simulated instruments')
+    parser.add_argument('--config', default=topology.topologyPath, help='Fixture topology, one per fixture when several run on this PC')
+    parser.add_argument('--settings', help='Settings file written by Main.py, defaults to the one named in the topology')
+    parser.add_argument('--host', default='127.0.0.1', help='Address to serve the API on, 0.0.0.0 to reach it from the PLC network (needs --token)')
+    parser.add_argument('--token', default=os.environ.get('LHC_API_TOKEN'),
+                        help="Bearer token POST requests must send as 'Authorization: Bearer <token>', defaults to $LHC_API_TOKEN")
+    parser.add_argument('--port', type=int, default=8750)
+    parser.add_argument('--spans', help='Append every phase span to this CSV file')
+    parser.add_argument('--once', action='store_true', help='Run one batch, print its status as JSON and exit, 1 if it faulted')
+    args = parser.parse_args()
+    if args.token is None and not is_loopback(args.host):
+        parser.error(f'--host {args.host} would let anyone on the network start batches, set --token or LHC_API_TOKEN')
+    apiToken = args.token
+
+    logListener = setup_logging(sys.stderr if args.once else None)
+    fixtureTopology = topology.load_topology(args.config)
+    engine.apply_topology(fixtureTopology)
+    load_settings(args.settings or fixtureTopology['settings'], args.simulate)
+    engine.resultsStore = results.ResultsStore(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'results.db'))
+    engine.resultsStore.start()
+    engine.tracer = tracing.Tracer(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'metrics.prom'), args.spans)
+    engine.load_spc_history()
+    engine.uiEvents = queue.SimpleQueue()
+    Thread(target=dispatch_events, daemon=True).start()
+    try:
+        if args.once:
+            with contextlib.redirect_stdout(sys.stderr):  # Keep stdout to the JSON status
+                engine.start_up(args.simulate)
+                run_batch()
+            batchDone.wait()  # Every event of the batch has been dispatched and logged
+            print(json.dumps(status(), indent=2))
+            sys.exit(1 if lastFault else 0)
+        Thread(target=engine.start_up, args=(args.simulate,), daemon=True).start()
+        server = ThreadingHTTPServer((args.host, args.port), ApiHandler)
+        server.daemon_threads = True
+        print(f'Serving on http://{args.host}:{server.server_address[1]}')
+        logger.info(f'Headless API serving on http://{args.host}:{server.server_address[1]}')
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        server.server_close()
+    finally:
+        engine.disable_all_switches()
+        engine.close_drivers()
+        engine.resultsStore.stop()
+        if logListener is not None:
+            logListener.stop()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,79 @@
+import enum
+import re
+
+
+# ReadTestDisplayRaw parsing: step,mode,status,readings... e.g. 01,ACW,PASS,1.000kV,0.512mA,0.052ohm,0.3s
+class Status(enum.Enum):
+    EMPTY = ''  # No status field, the instrument hasn't started a test
+    RAMP_UP = 'Ramp Up'
+    DWELL = 'Dwell'
+    RAMP_DOWN = 'Ramp Down'
+    DELAY = 'Delay'
+    PASS = 'PASS'
+    CONT_HI_LIMIT = 'Cont. Hi-Lmt'
+    HI_LIMIT = 'HI-LIMIT'
+    SHORT = 'Short'
+    BREAKDOWN = 'Breakdown'
+    UNKNOWN = None  # Anything else, the text is kept on the reading
+
+
+statusByText = {member.value: member for member in Status if member is not Status.UNKNOWN}
+readingUnits = (('kV', 'voltage'), ('mA', 'current'), ('ohm', 'resistance'), ('s', 'seconds'))  # Suffix of each reading, 'ohm' before 's'
+recordColumns = {'voltage': 'voltage_kv', 'current': 'current_ma', 'resistance': 'resistance_ohm', 'seconds': 'test_seconds'}  # results.db columns
+# Every line the 38XX displays during an ACW test has this layout, one match instead of splitting and scanning each field
+standardLine = re.compile(r'\s*(\d+),(\w*),([^,]*),[<>=T]?([-\d.]+)kV,[<>=T]?([-\d.]+)mA,[<>=T]?([-\d.]+)ohm,[<>=T]?([-\d.]+)s\s*')
+
+
+class Reading:
+    __slots__ = ('step', 'mode', 'status', 'statusText', 'voltage', 'current', 'resistance', 'seconds', 'raw')
+
+    def __init__(self, raw, step=None, mode='', statusText='', voltage=None, current=None, resistance=None, seconds=None):
+        self.raw = raw
+        self.step = step  # None when the step field isn't a number
+        self.mode = mode
+        self.statusText = statusText
+        self.status = statusByText.get(statusText) or statusByText.get(statusText.strip(), Status.UNKNOWN)
+        self.voltage = voltage  # kV
+        self.current = current  # mA
+        self.resistance = resistance  # ohm
+        self.seconds = seconds
+
+    def __repr__(self):
+        return (f'Reading(step={self.step}, mode={self.mode!r}, status={self.status.name}, statusText={self.statusText!r}, '
+                f'voltage={self.voltage}, current={self.current}, resistance={self.resistance}, seconds={self.seconds})')
+
+    def values(self):
+        # Readings the instrument gave, keyed by their results.db column
+        return {column: getattr(self, name) for name, column in recordColumns.items() if getattr(self, name) is not None}
+
+
+def parse(rawOutput):
+    match = standardLine.fullmatch(rawOutput)
+    if match is not None:
+        step, mode, statusText, voltage, current, resistance, seconds = match.groups()
+        try:
+            return Reading(rawOutput, int(step), mode, statusText, float(voltage), float(current), float(resistance), float(seconds))
+        except ValueError:  # A reading like 1.2.3 or a lone '-', the field by field parse keeps the rest
+            pass
+    return parse_fields(rawOutput)
+
+
+def parse_fields(rawOutput):
+    # Any other layout: missing or reordered readings, extra fields, a short line
+    fields = rawOutput.strip().split(',')
+    reading = Reading(rawOutput, int(fields[0]) if fields[0].strip().isdigit() else None,
+                      fields[1].strip() if len(fields) > 1 else '', fields[2] if len(fields) > 2 else '')
+    if reading.step is None and fields[0].strip():  # Not a display line at all, e.g. an error reply
+        reading.status = Status.UNKNOWN
+        reading.statusText = rawOutput.strip()
+        return reading
+    for field in fields[3:]:
+        field = field.strip()
+        for unit, name in readingUnits:
+            if field.endswith(unit):
+                try:
+                    setattr(reading, name, float(field[:-len(unit)].lstrip('<>=T')))
+                except ValueError:
+                    pass
+                break
+    return reading
@@ -0,0 +1,430 @@
+import logging
+import random
+import socket
+import threading
+import time
+from types import SimpleNamespace
+
+
+logger = logging.getLogger('Rotating Log')
+
+# Driver Variables
+hypotProgId = 'ARI38XX.ARI38XX'
+switchProgId = 'SC6540.SC6540'
+
+# Stand-in for the comtypes.gen.ARI38XXLib constants used by the settings
+SimARI38XXLib = SimpleNamespace(ARI38XXFrequency50Hz=0, ARI38XXFrequency60Hz=1)
+
+# Display states shown by the simulated hypot, same strings as the 3805 front panel
+simRunningStates = ('Ramp Up', 'Dwell', 'Ramp Down')
+simDefaultOutcomes = {'PASS': 0.96, 'HI-LIMIT': 0.02, 'Cont. Hi-Lmt': 0.02}
+
+
+def create_hypot_driver(simulate, cc=None, ARI38XXLib=None, **simOptions):
+    if simulate:
+        return SimHypot(**simOptions)
+    return cc.CreateObject(hypotProgId, interface=ARI38XXLib.IARI38XX)
+
+
+def create_switch_driver(simulate, cc=None, SC6540Lib=None, **simOptions):
+    if simulate:
+        return SimSwitch(**simOptions)
+    return cc.CreateObject(switchProgId, interface=SC6540Lib.ISC6540)
+
+
+class LaserClient:
+    # Keyence marker connection: replies framed on \r, per command timeouts and reconnects with backoff
+
+    def __init__(self, address, timeout=2.0, commandTimeouts=None, minBackoff=0.5, maxBackoff=30.0):
+        self.address = address
+        self.timeout = timeout  # Seconds to wait for a reply
+        self.commandTimeouts = commandTimeouts or {'WX,StartMarking': 15.0}  # Marking replies once the mark is done
+        self.minBackoff = minBackoff
+        self.maxBackoff = maxBackoff
+        self.backoff = minBackoff
+        self.nextAttempt = 0.0
+        self.laserSocket = None
+        self.buffer = b''
+        self.lock = threading.Lock()
+
+    def connect(self):
+        # Returns True if connected, skips the attempt while backing off from the last failure
+        if self.laserSocket is not None:
+            return True
+        if time.monotonic() < self.nextAttempt:
+            return False
+        try:
+            self.laserSocket = socket.create_connection(self.address, timeout=self.timeout)
+            self.laserSocket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            self.buffer = b''
+            self.backoff = self.minBackoff
+            logger.info(f'Laser Marker connected at {self.address}')
+            return True
+        except OSError as ex:
+            self.nextAttempt = time.monotonic() + self.backoff
+            logger.error(f'Connection to Laser Marker failed, retrying in {self.backoff} s: {ex}')
+            self.backoff = min(self.backoff * 2, self.maxBackoff)
+            return False
+
+    def disconnect(self):
+        if self.laserSocket is not None:
+            try:
+                self.laserSocket.close()
+            except OSError:
+                pass
+        self.laserSocket = None
+        self.buffer = b''
+
+    def command_timeout(self, command):
+        return self.commandTimeouts.get(command.split('=', 1)[0], self.timeout)
+
+    def read_reply(self, timeout):
+        deadline = time.monotonic() + timeout
+        while b'\r' not in self.buffer:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise TimeoutError('No reply from Laser Marker')
+            self.laserSocket.settimeout(remaining)
+            data = self.laserSocket.recv(1024)
+            if not data:
+                raise ConnectionError('Laser Marker closed the connection')
+            self.buffer += data
+        reply, self.buffer = self.buffer.split(b'\r', 1)
+        return reply.decode('utf-8')
+
+    def commands(self, commands):
+        # Sends every command in one write, then reads the replies in order. Read only (RX) batches retry once after a reconnect
+        commands = [command.rstrip('\r') for command in commands]
+        attempts = 2 if all(command.startswith('RX,') for command in commands) else 1
+        with self.lock:
+            for attempt in range(attempts):
+                if not self.connect():
+                    return ['ng,ng,ng'] * len(commands)  # Return no good strings
+                replies = []
+                try:
+                    self.laserSocket.sendall(''.join(command + '\r' for command in commands).encode('utf-8'))
+                    for command in commands:
+                        replies.append(self.read_reply(self.command_timeout(command)))
+                    return replies
+                except OSError as ex:  # Includes timeouts, the reply stream is out of step so start over on a new connection
+                    logger.error(f'Laser Marker connection lost: {ex}')
+                    self.disconnect()
+                    self.nextAttempt = 0.0  # Reconnect straight away, backoff only kicks in if that fails
+            return replies + ['ng,ng,ng'] * (len(commands) - len(replies))
+
+    def command(self, command):
+        return self.commands([command])[0]
+
+    def close(self):
+        with self.lock:
+            self.disconnect()
+
+
+class SimInstrument:
+    # Shared by the simulated hypot and switch: serial latency, round trip count and the System passthrough
+
+    def __init__(self, latency=0.005, seed=None):
+        self.latency = latency  # Seconds per serial round trip, 38400 baud USB-serial is a few ms
+        self.roundTrips = 0
+        self.resource = None
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.pendingReply = ''
+        self.System = SimpleNamespace(WriteString=self.write_string, ReadString=self.read_string)
+
+    def round_trip(self):
+        with self.lock:
+            self.roundTrips += 1
+        if self.latency:
+            time.sleep(self.latency)
+
+    def Initialize(self, resourceName, idQuery, reset, optionString):
+        self.round_trip()
+        self.resource = resourceName
+
+    def close(self):
+        self.resource = None
+
+    def write_string(self, command):
+        self.round_trip()
+        self.pendingReply = self.query(command.strip())
+
+    def read_string(self):
+        self.round_trip()
+        reply, self.pendingReply = self.pendingReply, ''
+        return reply + '\n'
+
+    def query(self, command):
+        if command == '*IDN?':
+            return 'Simulated,' + type(self).__name__ + ',0,1.0'
+        if command == '*OPC?':
+            return '1'
+        return ''
+
+
+class SimHypot(SimInstrument):
+    # ARI 3805 stand-in, times the test from the programmed ramp/dwell and picks an outcome per step on Execute.
+    # Multi-step files run their steps back to back, SS/SAA set a step's scanner string and RD n? reads a finished step
+
+    def __init__(self, latency=0.005, timeScale=1.0, outcomes=None, seed=None):
+        super().__init__(latency=latency, seed=seed)
+        self.timeScale = timeScale  # 1.0 runs ramp/dwell in real time, smaller values speed the simulation up
+        self.outcomes = outcomes or dict(simDefaultOutcomes)
+        self.files = {}
+        self.currentFile = None
+        self.startTime = None
+        self.aborted = False
+        self.results = []  # (status, current, resistance) per step of the running file
+        self.steps = []  # Scanner string per step of the current file, None if the step has no scanner assignment
+        self.selectedStep = 0
+        self.Parameters = SimpleNamespace(Voltage=1000, HighLimit=10, LowLimit=0.001, RampUp=0.1, Dwell=0.3, RampDown=0.0, ArcSense=1,
+                                          ArcDetectEnabled=False, Frequency=SimARI38XXLib.ARI38XXFrequency60Hz, ContinuityEnabled=True,
+                                          ContHiLimit=1.5, ContLoLimit=0.01, ContOffset=0.5)
+        self.Files = SimpleNamespace(Create=self.create_file, Delete=self.delete_file, Save=self.save_file, Load=self.load_file)
+        self.Steps = SimpleNamespace(AddACWTestWithDefaults=self.add_acw_test)
+        self.Execution = SimpleNamespace(Execute=self.execute, Abort=self.abort, ReadTestDisplayRaw=self.read_test_display_raw)
+
+    def create_file(self, fileNum, name):
+        self.round_trip()
+        if fileNum in self.files:
+            raise RuntimeError(f'File {fileNum} already exists')
+        self.files[fileNum] = {'name': name, 'parameters': None, 'steps': []}
+        self.currentFile = fileNum
+        self.steps = []
+
+    def delete_file(self, fileNum):
+        self.round_trip()
+        self.files.pop(fileNum, None)
+        if self.currentFile == fileNum:
+            self.currentFile = None
+
+    def save_file(self):
+        self.round_trip()
+        if self.currentFile is None:
+            raise RuntimeError('No file loaded')
+        self.files[self.currentFile]['parameters'] = dict(vars(self.Parameters))
+        self.files[self.currentFile]['steps'] = list(self.steps)
+
+    def load_file(self, fileNum):
+        self.round_trip()
+        if fileNum not in self.files or self.files[fileNum]['parameters'] is None:
+            raise RuntimeError(f'File {fileNum} does not exist')
+        self.currentFile = fileNum
+        for key, value in self.files[fileNum]['parameters'].items():
+            setattr(self.Parameters, key, value)
+        self.steps = list(self.files[fileNum]['steps'])
+
+    def add_acw_test(self):
+        self.round_trip()
+        self.steps.append(None)
+        self.selectedStep = len(self.steps) - 1
+
+    def step_time(self):
+        return (self.Parameters.RampUp + self.Parameters.Dwell + self.Parameters.RampDown) * self.timeScale
+
+    def test_time(self):
+        return self.step_time() * max(1, len(self.steps))
+
+    def pick_result(self):
+        statuses = list(self.outcomes)
+        status = self.random.choices(statuses, weights=[self.outcomes[x] for x in statuses])[0]
+        current = self.random.uniform(0.3, 0.7)
+        resistance = self.random.uniform(self.Parameters.ContLoLimit, self.Parameters.ContHiLimit * 0.5)
+        if status in ('HI-LIMIT', 'Short', 'Breakdown'):
+            current = self.Parameters.HighLimit * self.random.uniform(1.01, 1.5)
+        elif status == 'Cont. Hi-Lmt':
+            resistance = self.Parameters.ContHiLimit * self.random.uniform(1.01, 3.0)
+        return status, current, resistance
+
+    def execute(self):
+        self.round_trip()
+        self.results = [self.pick_result() for step in range(max(1, len(self.steps)))]
+        self.startTime = time.monotonic()
+        self.aborted = False
+
+    def abort(self):
+        self.round_trip()
+        self.aborted = True
+
+    def is_complete(self):
+        return self.startTime is None or self.aborted or time.monotonic() - self.startTime >= self.test_time()
+
+    def read_test_display_raw(self):
+        self.round_trip()
+        if self.startTime is None:
+            return '01,ACW,,0.000kV,0.000mA,0.000ohm,0.0s'
+        elapsed = time.monotonic() - self.startTime
+        stepTime = self.step_time()
+        if self.is_complete():
+            return self.step_display(len(self.results), stepTime)
+        step = min(int(elapsed / stepTime) if stepTime else 0, len(self.results) - 1) + 1  # Display follows the running step
+        return self.step_display(step, elapsed - (step - 1) * stepTime)
+
+    def step_display(self, step, stepElapsed):
+        rampUp = self.Parameters.RampUp * self.timeScale
+        dwell = self.Parameters.Dwell * self.timeScale
+        status, current, resistance = self.results[step - 1]
+        voltage = self.Parameters.Voltage / 1000
+        if stepElapsed < self.step_time() and not self.aborted:
+            if stepElapsed < rampUp:
+                status = 'Ramp Up'
+                voltage *= stepElapsed / rampUp
+                current *= stepElapsed / rampUp
+            elif stepElapsed < rampUp + dwell:
+                status = 'Dwell'
+            else:
+                status = 'Ramp Down'
+        seconds = min(stepElapsed, self.step_time()) / self.timeScale if self.timeScale else 0.0
+        return f'{step:02d},ACW,{status},{voltage:.3f}kV,{current:.3f}mA,{resistance:.3f}ohm,{seconds:.1f}s'
+
+    def query(self, command):
+        if command == '*OPC?':
+            return '1' if self.is_complete() else '0'
+        if command.startswith('SS '):
+            self.selectedStep = int(command[3:]) - 1
+            return ''
+        if command.startswith('SAA '):
+            self.steps[self.selectedStep] = command[4:]
+            return ''
+        if command.startswith('RD ') and command.endswith('?'):
+            step = int(command[3:-1])
+            # Only steps that finished have a result, like the 3805 after fail stop
+            if self.startTime is None or not 1 <= step <= len(self.results) or time.monotonic() - self.startTime < step * self.step_time():
+                return ''
+            return self.step_display(step, self.step_time())
+        return super().query(command)
+
+
+class SimSwitch(SimInstrument):
+    # SC6540 stand-in, tracks which relays are engaged and holds *OPC? until they settled
+
+    def __init__(self, latency=0.005, channelCount=10, settleRange=(0.004, 0.012), seed=None):
+        super().__init__(latency=latency, seed=seed)
+        self.channelCount = channelCount
+        self.withstandChannels = set()
+        self.returnChannels = set()
+        self.settleTimes = {channel: self.random.uniform(*settleRange) for channel in range(1, channelCount + 1)}  # Seconds per relay
+        self.settledAt = 0.0  # Monotonic time the last switched relay settles
+        self.Execution = SimpleNamespace(ConfigureWithstandChannels=self.configure_withstand_channels,
+                                         ConfigureReturnChannels=self.configure_return_channels,
+                                         DisableAllChannels=self.disable_all_channels)
+
+    def check_channels(self, channels):
+        for channel in channels:
+            if not 1 <= channel <= self.channelCount:
+                raise ValueError(f'Channel {channel} out of range 1-{self.channelCount}')
+        return set(channels)
+
+    def switch_relays(self, channels):
+        if channels:
+            self.settledAt = max(self.settledAt, time.monotonic() + max(self.settleTimes[x] for x in channels))
+
+    def configure_withstand_channels(self, channels):
+        self.round_trip()
+        self.withstandChannels |= self.check_channels(channels)
+        self.returnChannels -= self.withstandChannels
+        self.switch_relays(channels)
+
+    def configure_return_channels(self, channels):
+        self.round_trip()
+        self.returnChannels |= self.check_channels(channels)
+        self.withstandChannels -= self.returnChannels
+        self.switch_relays(channels)
+
+    def disable_all_channels(self):
+        self.round_trip()
+        self.switch_relays(self.engaged_channels())
+        self.withstandChannels.clear()
+        self.returnChannels.clear()
+
+    def query(self, command):
+        if command == '*OPC?':  # Answers once every relay finished switching
+            time.sleep(max(0.0, self.settledAt - time.monotonic()))
+            return '1'
+        return super().query(command)
+
+    def engaged_channels(self):
+        return self.withstandChannels | self.returnChannels
+
+
+class SimLaserServer:
+    # Local TCP stand-in for the Keyence MD-X1000, speaks the RX,/WX, command protocol terminated by \r
+
+    def __init__(self, host='127.0.0.1', port=0, latency=0.002, markTime=1.0, programLoadTime=0.0, programCount=10):
+        self.latency = latency  # Seconds before each reply
+        self.markTime = markTime  # Seconds StartMarking takes before the marker answers
+        self.programLoadTime = programLoadTime  # Seconds WX,ProgramNo takes to load a different program
+        self.programCount = programCount
+        self.programNo = 0
+        self.marks = []  # Program numbers marked, in order
+        self.roundTrips = 0
+        self.serverSocket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.serverSocket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.serverSocket.bind((host, port))
+        self.address = self.serverSocket.getsockname()
+        self.running = False
+
+    def start(self):
+        self.running = True
+        self.serverSocket.listen()
+        threading.Thread(target=self.accept_loop, daemon=True).start()
+        return self.address
+
+    def stop(self):
+        self.running = False
+        try:
+            self.serverSocket.close()
+        except OSError:
+            pass
+
+    def accept_loop(self):
+        while self.running:
+            try:
+                clientSocket, _ = self.serverSocket.accept()
+            except OSError:
+                return
+            threading.Thread(target=self.client_loop, args=(clientSocket,), daemon=True).start()
+
+    def client_loop(self, clientSocket):
+        buffer = b''
+        with clientSocket:
+            while self.running:
+                try:
+                    data = clientSocket.recv(1024)
+                except OSError:
+                    return
+                if not data:
+                    return
+                buffer += data
+                while b'\r' in buffer:
+                    command, buffer = buffer.split(b'\r', 1)
+                    reply = self.handle(command.decode('utf-8').strip())
+                    if self.latency:
+                        time.sleep(self.latency)
+                    try:
+                        clientSocket.sendall((reply + '\r').encode('utf-8'))
+                    except OSError:
+                        return
+
+    def handle(self, command):
+        self.roundTrips += 1
+        if command == 'RX,Ready':
+            return 'RX,OK,1'
+        if command == 'RX,ProgramNo':
+            return 'RX,OK,' + str(self.programNo)
+        if command.startswith('WX,ProgramNo='):
+            try:
+                programNo = int(command.split('=', 1)[1])
+            except ValueError:
+                return 'ER,WX,22'
+            if not 0 <= programNo < self.programCount:
+                return 'ER,WX,22'
+            if programNo != self.programNo:
+                time.sleep(self.programLoadTime)
+            self.programNo = programNo
+            return 'WX,OK'
+        if command == 'WX,StartMarking':
+            time.sleep(self.markTime)
+            self.marks.append(self.programNo)
+            return 'WX,OK'
+        return 'ER,' + command.split(',', 1)[0] + ',0'
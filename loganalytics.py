@@ -0,0 +1,227 @@
+import argparse
+import array
+import datetime
+import glob
+import json
+import os
+import statistics
+import time
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
+
+import hypotdisplay
+from hypotdisplay import Status
+
+
+# Log analytics: yield, failure types and cycle times from the rotated LaserHypotCont.log files, one worker process per file
+defaultLogGlob = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'logs', 'LaserHypotCont.log*')
+runningStatuses = (Status.EMPTY, Status.RAMP_UP, Status.DWELL, Status.RAMP_DOWN, Status.DELAY)  # Display readings that aren't a result yet
+pendingLimit = 16  # Finished readings kept waiting for their result line, banks log at most one each before it
+infoMarker = ' - INFO - '  # Between the logger name and the message, logqueue.logFormat
+
+
+class LogSummary:
+
+    def __init__(self):
+        self.files = 0
+        self.lines = 0
+        self.batches = 0
+        self.firstTime = None  # Timestamp text of the first and last line counted
+        self.lastTime = None
+        self.cavities = {}  # Cavity: [batches tested, passed on the final attempt, retests]
+        self.failureTypes = {}  # Display status (or Hypot/Continuity when no reading was logged): failed attempts
+        self.cavitySeconds = array.array('d')  # Running Cavity to its result, every attempt
+        self.laserSeconds = array.array('d')  # Lasering Cavity to Laser Done
+        self.batchSeconds = array.array('d')  # First Running Cavity to the Hypot results line
+
+    def merge(self, other):
+        self.files += other.files
+        self.lines += other.lines
+        self.batches += other.batches
+        for timeText in (other.firstTime, other.lastTime):
+            if timeText is not None:
+                self.firstTime = min(self.firstTime or timeText, timeText)
+                self.lastTime = max(self.lastTime or timeText, timeText)
+        for cavity, counts in other.cavities.items():
+            totals = self.cavities.setdefault(cavity, [0, 0, 0])
+            for index, value in enumerate(counts):
+                totals[index] += value
+        for failureType, count in other.failureTypes.items():
+            self.failureTypes[failureType] = self.failureTypes.get(failureType, 0) + count
+        self.cavitySeconds.extend(other.cavitySeconds)
+        self.laserSeconds.extend(other.laserSeconds)
+        self.batchSeconds.extend(other.batchSeconds)
+
+    def report(self):
+        return {'files': self.files, 'lines': self.lines, 'batches': self.batches, 'from': self.firstTime, 'to': self.lastTime,
+                'cavities': {cavity: {'tested': tested, 'passed': passed, 'yield': passed / tested if tested else None, 'retests': retests}
+                             for cavity, (tested, passed, retests) in sorted(self.cavities.items())},
+                'failureTypes': dict(sorted(self.failureTypes.items(), key=lambda item: -item[1])),
+                'cycleTimes': {'cavity test': distribution(self.cavitySeconds), 'laser': distribution(self.laserSeconds),
+                               'batch': distribution(self.batchSeconds)}}
+
+
+def line_time(line):
+    # '2024-05-02 14:03:11,482 - ...' as epoch seconds, only differences are used
+    return datetime.datetime(int(line[0:4]), int(line[5:7]), int(line[8:10]), int(line[11:13]), int(line[14:16]), int(line[17:19]),
+                             int(line[20:23]) * 1000).timestamp()
+
+
+def claim_reading(pendingReadings, passed):
+    # Banks log in parallel, a result takes the newest finished reading of its kind nobody claimed
+    for index in range(len(pendingReadings) - 1, -1, -1):
+        if (pendingReadings[index].status is Status.PASS) == passed:
+            return pendingReadings.pop(index)
+    return None
+
+
+def analyze_file(path, since=None):
+    # Streams one log file, batches cut by a rotation are counted without a batch time
+    summary = LogSummary()
+    summary.files = 1
+    runningSince = {}  # Cavity: time of its last Running Cavity line
+    batchResults = {}  # Cavity: passed, for the batch in progress, a retest overwrites the first attempt
+    batchRetests = {}
+    pendingReadings = []
+    batchStart = None
+    lasering = None  # Time of the last Lasering Cavity line, Laser Done closes it
+
+    def finish_batch():
+        for cavity, passed in batchResults.items():
+            counts = summary.cavities.setdefault(cavity, [0, 0, 0])
+            counts[0] += 1
+            counts[1] += passed
+            counts[2] += batchRetests.get(cavity, 0)
+        summary.batches += bool(batchResults)
+        batchResults.clear()
+        batchRetests.clear()
+
+    with open(path, encoding='utf-8', errors='replace') as logFile:
+        for line in logFile:
+            markerAt = line.find(infoMarker, 23)
+            if markerAt < 0 or (since is not None and line[:19] < since):  # Timestamps sort as text
+                continue
+            message = line[markerAt + len(infoMarker):].rstrip('\n')
+            try:
+                if message.startswith('Raw Output: '):
+                    reading = hypotdisplay.parse(message[12:])
+                    if reading.status not in runningStatuses:
+                        pendingReadings.append(reading)
+                        del pendingReadings[:-pendingLimit]
+                    continue
+                if message.startswith('Running Cavity: '):
+                    cavity = int(message[16:])
+                    lineTime = line_time(line)
+                    if batchStart is None:
+                        batchStart = lineTime
+                    if cavity in batchResults:
+                        batchRetests[cavity] = batchRetests.get(cavity, 0) + 1
+                    runningSince[cavity] = lineTime
+                elif message.startswith('Cavity ') and (message.endswith(' passes hypot & continuity') or ' fails ' in message):
+                    cavity = int(message[7:message.index(' ', 7)])
+                    passed = message.endswith(' passes hypot & continuity')
+                    if not passed:
+                        reading = claim_reading(pendingReadings, False)
+                        failureType = reading.statusText.strip() if reading is not None else message.rsplit(' ', 1)[1]
+                        summary.failureTypes[failureType] = summary.failureTypes.get(failureType, 0) + 1
+                    else:
+                        claim_reading(pendingReadings, True)
+                    batchResults[cavity] = passed
+                    if cavity in runningSince:
+                        summary.cavitySeconds.append(line_time(line) - runningSince.pop(cavity))
+                elif message.startswith('Lasering Cavity: '):
+                    lasering = line_time(line)
+                elif message == 'Laser Done':
+                    if lasering is not None:
+                        summary.laserSeconds.append(line_time(line) - lasering)
+                    lasering = None
+                elif message.startswith('Hypot results:'):
+                    if batchStart is not None:
+                        summary.batchSeconds.append(line_time(line) - batchStart)
+                    finish_batch()
+                    batchStart = None
+                    runningSince.clear()
+                    pendingReadings.clear()
+                else:
+                    continue
+            except ValueError:  # Line cut short by a crash or a rotation
+                continue
+            summary.lines += 1
+            summary.firstTime = summary.firstTime or line[:23]
+            summary.lastTime = line[:23]
+    finish_batch()
+    return summary
+
+
+def distribution(values):
+    if not values:
+        return {'count': 0}
+    quantiles = statistics.quantiles(values, n=100, method='inclusive') if len(values) > 1 else [values[0]] * 99
+    return {'count': len(values), 'mean': statistics.fmean(values), 'p50': quantiles[49], 'p95': quantiles[94], 'p99': quantiles[98],
+            'max': max(values)}
+
+
+def log_files(patterns, since):
+    # Rotations last written before the start of the window can't hold anything in it
+    paths = sorted({path for pattern in patterns for path in glob.glob(pattern)})
+    if since is not None:
+        sinceTime = time.mktime(time.strptime(since, '%Y-%m-%d %H:%M:%S'))
+        paths = [path for path in paths if os.path.getmtime(path) >= sinceTime]
+    return paths
+
+
+def print_report(report):
+    print(f"{report['files']} files, {report['batches']} batches, {report['from']} to {report['to']}")
+    print()
+    print(f"{'cavity':<8}{'tested':>8}{'passed':>8}{'yield':>9}{'retests':>9}")
+    for cavity, counts in report['cavities'].items():
+        print(f"{cavity:<8}{counts['tested']:>8}{counts['passed']:>8}{counts['yield'] * 100:>8.1f}%{counts['retests']:>9}")
+    print()
+    totalFailures = sum(report['failureTypes'].values())
+    print(f"{'failure type':<20}{'attempts':>10}{'share':>9}")
+    for failureType, count in report['failureTypes'].items():
+        print(f"{failureType:<20}{count:>10}{count / totalFailures * 100:>8.1f}%")
+    print()
+    print(f"{'cycle time (s)':<16}{'count':>8}{'mean':>9}{'p50':>9}{'p95':>9}{'p99':>9}{'max':>9}")
+    for name, stats in report['cycleTimes'].items():
+        if stats['count']:
+            print(f"{name:<16}{stats['count']:>8}{stats['mean']:>9.3f}{stats['p50']:>9.3f}{stats['p95']:>9.3f}{stats['p99']:>9.3f}{stats['max']:>9.3f}")
+        else:
+            print(f"{name:<16}{0:>8}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Yield, failure types and cycle times from the LaserHypotCont logs')
+    parser.add_argument('paths', nargs='*', default=[defaultLogGlob], help='Log files or glob patterns, defaults to logs/LaserHypotCont.log*')
+    parser.add_argument('--days', type=float, help='Only the last N days')
+    parser.add_argument('--since', help="Only lines from this time on, 'YYYY-MM-DD' or 'YYYY-MM-DD HH:MM:SS'")
+    parser.add_argument('--workers', type=int, default=os.cpu_count(), help='Processes parsing files at the same time')
+    parser.add_argument('--json', help='Also write the report to this file')
+    args = parser.parse_args()
+
+    since = args.since
+    if args.days is not None:
+        since = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(time.time() - args.days * 86400))
+    elif since is not None and len(since) == 10:
+        since += ' 00:00:00'
+    paths = log_files(args.paths, since)
+    if not paths:
+        parser.error(f"No log files match {' '.join(args.paths)}")
+
+    total = LogSummary()
+    if args.workers > 1 and len(paths) > 1:
+        with ProcessPoolExecutor(max_workers=min(args.workers, len(paths))) as pool:
+            for summary in pool.map(analyze_file, paths, repeat(since)):
+                total.merge(summary)
+    else:
+        for path in paths:
+            total.merge(analyze_file(path, since))
+    report = total.report()
+    print_report(report)
+    if args.json:
+        with open(args.json, 'w') as reportFile:
+            json.dump(report, reportFile, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,67 @@
+import logging
+import logging.handlers
+import queue
+import sys
+
+
+# Queued logging: the test threads only put records on a queue, a listener thread formats, echoes and writes them
+logFormat = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+rateLimit = 0.5  # Seconds between logged lines that share a rateKey, e.g. hypot polls of one cavity
+
+
+class ConsoleEchoFilter(logging.Filter):
+    # Only records logged with extra={'echo': True} go to the console, everything else is already printed where it happens
+    def filter(self, record):
+        return getattr(record, 'echo', False)
+
+
+class DedupingQueueListener(logging.handlers.QueueListener):
+    # Collapses identical consecutive lines and rate limits lines that share a rateKey, off the test threads
+
+    def __init__(self, logQueue, *handlers):
+        super().__init__(logQueue, *handlers, respect_handler_level=True)
+        self.lastRecord = None
+        self.repeats = 0
+        self.rateKeys = {}  # rateKey: (time the last line was logged, lines suppressed since)
+
+    def handle(self, record):
+        if self.lastRecord is not None and record.getMessage() == self.lastRecord.getMessage() and record.levelno == self.lastRecord.levelno:
+            self.repeats += 1
+            return
+        self.flush_repeats()
+        self.lastRecord = record
+        rateKey = getattr(record, 'rateKey', None)
+        if rateKey is not None:
+            lastTime, suppressed = self.rateKeys.get(rateKey, (0.0, 0))
+            if record.created - lastTime < rateLimit and not getattr(record, 'rateFinal', False):
+                self.rateKeys[rateKey] = (lastTime, suppressed + 1)
+                return
+            self.rateKeys[rateKey] = (record.created, 0)
+            if suppressed:  # Own line so the record itself stays parseable
+                super().handle(logging.makeLogRecord(dict(record.__dict__, msg=f'{suppressed} similar lines suppressed', args=None, echo=False)))
+        super().handle(record)
+
+    def flush_repeats(self):
+        if self.repeats:
+            summary = logging.makeLogRecord(dict(self.lastRecord.__dict__, msg=f'Previous message repeated {self.repeats} times', args=None))
+            self.repeats = 0
+            super().handle(summary)
+
+    def stop(self):
+        super().stop()
+        self.flush_repeats()
+
+
+def setup_logging(logger, fileHandler, queued=True, echoStream=None):
+    # Returns the started listener, stop it before exiting so queued records reach the file. None when logging synchronously
+    fileHandler.setFormatter(logging.Formatter(logFormat))
+    if not queued:
+        logger.addHandler(fileHandler)
+        return None
+    consoleHandler = logging.StreamHandler(echoStream or sys.stdout)
+    consoleHandler.addFilter(ConsoleEchoFilter())
+    logQueue = queue.SimpleQueue()
+    logger.addHandler(logging.handlers.QueueHandler(logQueue))
+    listener = DedupingQueueListener(logQueue, fileHandler, consoleHandler)
+    listener.start()
+    return listener
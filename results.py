@@ -0,0 +1,157 @@
+import contextlib
+import logging
+import queue
+import sqlite3
+import threading
+import time
+
+
+# Results Database: every batch and cavity, written off the test thread in batched transactions
+logger = logging.getLogger('Rotating Log')
+
+shiftStartHour = 6  # First shift of the day starts at 06:00
+shiftLength = 8  # Hours per shift, same as the log rotation
+
+schema = '''
+CREATE TABLE IF NOT EXISTS batches (
+    id TEXT PRIMARY KEY,
+    started_at REAL NOT NULL,
+    finished_at REAL,
+    shift TEXT NOT NULL,
+    fault INTEGER NOT NULL DEFAULT 0
+);
+CREATE TABLE IF NOT EXISTS cavities (
+    batch_id TEXT NOT NULL REFERENCES batches(id),
+    cavity INTEGER NOT NULL,
+    attempt INTEGER NOT NULL DEFAULT 1,
+    shift TEXT NOT NULL,
+    started_at REAL,
+    finished_at REAL,
+    hypot_code INTEGER,
+    continuity_code INTEGER,
+    passed INTEGER,
+    failure_type TEXT,
+    raw_output TEXT,
+    voltage_kv REAL,
+    current_ma REAL,
+    resistance_ohm REAL,
+    test_seconds REAL,
+    laser_outcome TEXT,
+    PRIMARY KEY (batch_id, cavity, attempt)
+);
+CREATE INDEX IF NOT EXISTS batches_started ON batches (started_at);
+CREATE INDEX IF NOT EXISTS batches_shift ON batches (shift);
+CREATE INDEX IF NOT EXISTS cavities_cavity_started ON cavities (cavity, started_at);
+CREATE INDEX IF NOT EXISTS cavities_shift_cavity ON cavities (shift, cavity);
+'''
+
+cavityColumns = ('batch_id', 'cavity', 'attempt', 'shift', 'started_at', 'finished_at', 'hypot_code', 'continuity_code', 'passed', 'failure_type',
+                 'raw_output', 'voltage_kv', 'current_ma', 'resistance_ohm', 'test_seconds', 'laser_outcome')
+
+
+def shift_name(timestamp):
+    # Shifts that start before midnight keep the date they started on
+    shiftTime = time.localtime(timestamp - shiftStartHour * 3600)
+    return time.strftime('%Y-%m-%d', shiftTime) + ' S' + str(shiftTime.tm_hour // shiftLength + 1)
+
+
+class ResultsStore:
+
+    def __init__(self, path, maxPending=200, flushInterval=1.0):
+        self.path = path
+        self.maxPending = maxPending  # Rows written per transaction at most
+        self.flushInterval = flushInterval  # Seconds a row may wait before it is committed
+        self.writeQueue = queue.Queue()
+        self.writerThread = None
+
+    def connect(self):
+        connection = sqlite3.connect(self.path, timeout=10)
+        connection.execute('PRAGMA journal_mode=WAL')  # Readers never block the writer
+        connection.execute('PRAGMA synchronous=NORMAL')
+        return connection
+
+    def start(self):
+        with contextlib.closing(self.connect()) as connection:
+            connection.executescript(schema)
+        self.writerThread = threading.Thread(target=self.writer_loop, daemon=True)
+        self.writerThread.start()
+
+    def stop(self):
+        if self.writerThread is not None:
+            self.writeQueue.put(None)
+            self.writerThread.join()
+            self.writerThread = None
+
+    def record_batch(self, batchId, startedAt, finishedAt, fault, cavityRows):
+        # Only queues the rows, the writer thread does the database work
+        self.writeQueue.put(('batch', (batchId, startedAt, finishedAt, shift_name(startedAt), int(fault))))
+        for row in cavityRows:
+            row = dict(row, batch_id=batchId, shift=shift_name(row.get('started_at') or startedAt))
+            self.writeQueue.put(('cavity', tuple(row.get(column) for column in cavityColumns)))
+
+    def writer_loop(self):
+        connection = self.connect()
+        running = True
+        while running:
+            pending = []
+            item = self.writeQueue.get()
+            deadline = time.monotonic() + self.flushInterval
+            while item is not None:
+                pending.append(item)
+                if len(pending) >= self.maxPending:
+                    break
+                try:
+                    item = self.writeQueue.get(timeout=max(0.0, deadline - time.monotonic()))
+                except queue.Empty:
+                    break
+            if item is None:
+                running = False
+            if pending:
+                self.write(connection, pending)
+        connection.close()
+
+    def write(self, connection, pending):
+        batchRows = [row for kind, row in pending if kind == 'batch']
+        cavityRows = [row for kind, row in pending if kind == 'cavity']
+        try:
+            with connection:
+                connection.executemany('INSERT OR REPLACE INTO batches (id, started_at, finished_at, shift, fault) VALUES (?, ?, ?, ?, ?)', batchRows)
+                connection.executemany(f"INSERT OR REPLACE INTO cavities ({', '.join(cavityColumns)}) VALUES ({', '.join('?' * len(cavityColumns))})",
+                                       cavityRows)
+        except sqlite3.Error as ex:
+            logger.error(f'Error writing {len(pending)} results to {self.path}: {ex}')
+
+    def yield_by_cavity(self, since=0.0, until=None):
+        # {cavity: (tested, passed)} for the final attempt of every tested cavity
+        with contextlib.closing(self.connect()) as connection:
+            rows = connection.execute('''
+                SELECT cavity, COUNT(*), SUM(passed) FROM cavities c
+                WHERE started_at >= ? AND started_at < ? AND passed IS NOT NULL
+                  AND attempt = (SELECT MAX(attempt) FROM cavities WHERE batch_id = c.batch_id AND cavity = c.cavity)
+                GROUP BY cavity ORDER BY cavity''', (since, until if until is not None else time.time() + 1)).fetchall()
+        return {cavity: (tested, passed or 0) for cavity, tested, passed in rows}
+
+    def yield_by_shift(self, cavity=None):
+        # {shift: (tested, passed)}, optionally for one cavity
+        query = '''SELECT shift, COUNT(*), SUM(passed) FROM cavities c
+                   WHERE passed IS NOT NULL AND attempt = (SELECT MAX(attempt) FROM cavities WHERE batch_id = c.batch_id AND cavity = c.cavity)'''
+        parameters = ()
+        if cavity is not None:
+            query += ' AND cavity = ?'
+            parameters = (cavity,)
+        with contextlib.closing(self.connect()) as connection:
+            rows = connection.execute(query + ' GROUP BY shift ORDER BY shift', parameters).fetchall()
+        return {shift: (tested, passed or 0) for shift, tested, passed in rows}
+
+    def recent_readings(self, batches):
+        # [{cavity: {'current_ma', 'resistance_ohm'}}] of the final attempts in the last batches, oldest first
+        with contextlib.closing(self.connect()) as connection:
+            rows = connection.execute('''
+                SELECT c.batch_id, c.cavity, c.current_ma, c.resistance_ohm FROM cavities c
+                JOIN (SELECT id, started_at FROM batches ORDER BY started_at DESC LIMIT ?) b ON b.id = c.batch_id
+                WHERE c.attempt = (SELECT MAX(attempt) FROM cavities WHERE batch_id = c.batch_id AND cavity = c.cavity)
+                ORDER BY b.started_at, c.cavity''', (batches,)).fetchall()
+        batchRecords = {}
+        for batchId, cavity, current, resistance in rows:
+            batchRecords.setdefault(batchId, {})[cavity] = {'current_ma': current, 'resistance_ohm': resistance}
+        return list(batchRecords.values())
@@ -0,0 +1,64 @@
+import numpy as np
+
+
+# Statistical Process Control: each cavity's readings over the last batches in ring buffers, every statistic computed for all cavities at once
+metrics = (('current_ma', 'currenthighlimit', 'Current'), ('resistance_ohm', 'highlimitresistance', 'Resistance'))  # Reading, hypotSettings high limit, label
+
+
+class SpcTracker:
+
+    def __init__(self, cavities, window=50):
+        self.cavities = list(cavities)
+        self.rows = {cavity: row for row, cavity in enumerate(self.cavities)}
+        self.window = window
+        self.readings = np.full((len(metrics), len(self.cavities), window), np.nan)  # Metric, cavity, batch slot. NaN where a cavity wasn't measured
+        self.position = 0  # Slot the next batch goes in, the oldest one once the window is full
+        self.stats = {}  # Arrays of the last evaluate(), (metric, cavity)
+
+    def add_batch(self, cavityRecords):
+        slot = self.readings[:, :, self.position]
+        slot.fill(np.nan)
+        for cavity, record in cavityRecords.items():
+            row = self.rows.get(cavity)
+            if row is None:
+                continue
+            for index, (column, limitKey, label) in enumerate(metrics):
+                if record.get(column) is not None:
+                    slot[index, row] = record[column]
+        self.position = (self.position + 1) % self.window
+
+    def evaluate(self, hypotSettings, minSamples=10, cpkLimit=1.33, driftBatches=5, driftSigma=2.0):
+        # Returns {cavity: [reasons]} for the cavities heading towards a high limit
+        valid = ~np.isnan(self.readings)
+        values = np.where(valid, self.readings, 0.0)
+        recentSlots = np.zeros(self.window, dtype=bool)
+        recentSlots[(self.position - 1 - np.arange(min(driftBatches, self.window))) % self.window] = True
+        limits = np.array([float(hypotSettings[limitKey]) for column, limitKey, label in metrics])[:, None]
+        with np.errstate(divide='ignore', invalid='ignore'):  # Cavities without enough readings come out NaN and never alarm
+            counts, means, sigmas = masked_stats(values, valid)
+            recentCounts, recentMeans, recentSigmas = masked_stats(values, valid & recentSlots)
+            baseCounts, baseMeans, baseSigmas = masked_stats(values, valid & ~recentSlots)
+            cpks = (limits - means) / (3 * sigmas)  # One sided, the high limit is the side parts fail on
+            drifts = (recentMeans - baseMeans) / baseSigmas  # Positive is towards the high limit
+        enough = counts >= minSamples
+        lowCpk = enough & (cpks < cpkLimit)
+        drifting = enough & (recentCounts > 0) & (baseCounts >= 2) & (drifts >= driftSigma)
+        self.stats = {'counts': counts, 'means': means, 'sigmas': sigmas, 'cpks': cpks, 'drifts': drifts}
+
+        trending = {}
+        for index, row in zip(*np.nonzero(lowCpk | drifting)):
+            reasons = trending.setdefault(self.cavities[row], [])
+            label = metrics[index][2]
+            if lowCpk[index, row]:
+                reasons.append(f'{label} Cpk {cpks[index, row]:.2f}')
+            if drifting[index, row]:
+                reasons.append(f'{label} drift +{drifts[index, row]:.1f} sigma')
+        return trending
+
+
+def masked_stats(values, mask):
+    # Count, mean and sample standard deviation over the batch axis of the readings under mask
+    counts = np.count_nonzero(mask, axis=2)
+    means = np.sum(values, axis=2, where=mask) / counts
+    squares = np.sum(np.square(values - means[:, :, None]), axis=2, where=mask)
+    return counts, means, np.sqrt(squares / (counts - 1))
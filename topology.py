@@ -0,0 +1,61 @@
+import logging
+import math
+
+import yaml
+
+
+# Fixture topology: which hypot, switch, channels and laser program every cavity uses, read from config.yaml
+logger = logging.getLogger('Rotating Log')
+topologyPath = 'config.yaml'
+
+# The stock fixture, used while config.yaml has no banks
+defaultTopology = {
+    'banks': [
+        {'hypot': 'hypot1', 'switch': 'switch1', 'cavities': [1, 2, 3, 4, 5]},
+        {'hypot': 'hypot2', 'switch': 'switch2', 'cavities': [6, 7, 8, 9, 10]},
+    ],
+}
+instrumentTypes = ('hypot', 'switch')  # Instrument names start with their type, e.g. hypot3, switch3
+
+
+def load_topology(path=topologyPath):
+    try:
+        with open(path) as topologyFile:
+            description = yaml.safe_load(topologyFile) or {}
+    except FileNotFoundError:
+        description = {}
+    if not description.get('banks'):
+        logger.info(f'No fixture banks in {path}, using the stock 10 cavity fixture')
+        description = dict(defaultTopology, **description)
+    return build_topology(description)
+
+
+def build_topology(description):
+    # banks: {bankNum: [cavities in run order]}, cavities: {cavity: {bank, hypot, switch, high, return, program}},
+    # labels: {instrument: label}, grid: (rows, columns) of the UI rectangles, settings: settings file of this fixture
+    banks = {}
+    cavities = {}
+    labels = {}
+    overrides = description.get('cavities') or {}
+    for bankNum, bank in enumerate(description['banks'], start=1):
+        for name in (bank['hypot'], bank['switch']):
+            if not name.startswith(instrumentTypes):
+                raise ValueError(f'Instrument {name} has to start with hypot or switch')
+        banks[bankNum] = []
+        for position, cavitynum in enumerate(bank['cavities'], start=1):
+            if cavitynum in cavities:
+                raise ValueError(f'Cavity {cavitynum} is in more than one bank')
+            # Default wiring: each cavity takes the next return/high channel pair on its bank's switch
+            cavity = {'bank': bankNum, 'hypot': bank['hypot'], 'switch': bank['switch'],
+                      'return': 2 * position - 1, 'high': 2 * position, 'program': cavitynum - 1}
+            cavity.update(overrides.get(cavitynum) or {})
+            cavities[cavitynum] = cavity
+            banks[bankNum].append(cavitynum)
+        labels.setdefault(bank['hypot'], bank['hypot'].capitalize())
+        labels.setdefault(bank['switch'], 'SC6540 ' + bank['switch'].capitalize())
+    labels.update(description.get('labels') or {})
+    grid = description.get('grid') or {}
+    rows = grid.get('rows') or max(len(bankCavities) for bankCavities in banks.values())
+    columns = grid.get('columns') or math.ceil(len(cavities) / rows)
+    return {'banks': banks, 'cavities': dict(sorted(cavities.items())), 'labels': labels, 'grid': (rows, columns),
+            'settings': description.get('settings') or 'settings.ini'}
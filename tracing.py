@@ -0,0 +1,145 @@
+import bisect
+import contextlib
+import csv
+import logging
+import os
+import threading
+import time
+
+import results
+
+
+# Batch Tracing: a span per phase of every cavity, per shift aggregates exported after each batch
+logger = logging.getLogger('Rotating Log')
+
+metricPrefix = 'lhc'
+batchBuckets = (10, 15, 20, 30, 45, 60, 90, 120, 180)  # Seconds per batch
+cavityBuckets = (0.5, 1, 1.5, 2, 3, 5, 8, 13, 20)  # Seconds per cavity, switch to result
+phaseBuckets = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)  # Seconds per phase
+spanColumns = ('batch_id', 'shift', 'phase', 'bank', 'cavity', 'instrument', 'started_at', 'seconds', 'round_trips')
+
+
+class Histogram:
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # Last one is +Inf
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+class Tracer:
+
+    def __init__(self, metricsPath=None, spansPath=None):
+        self.metricsPath = metricsPath  # Prometheus text file, rewritten after every batch. None keeps the aggregates in memory
+        self.spansPath = spansPath  # CSV every span is appended to, None to skip
+        self.local = threading.local()  # Open spans of each thread, children inherit their tags
+        self.lock = threading.Lock()
+        self.spans = []  # Finished spans of the batch being run
+        self.batchStart = None
+        self.counters = {}  # (metric, labels): value, since the program started
+        self.histograms = {}  # (metric, labels): Histogram
+
+    @contextlib.contextmanager
+    def span(self, phase, **tags):
+        stack = self.local.__dict__.setdefault('stack', [])
+        record = {'phase': phase, 'tags': dict(stack[-1]['tags'], **tags) if stack else tags, 'round_trips': 0, 'started_at': time.time()}
+        stack.append(record)
+        startTime = time.perf_counter()
+        try:
+            yield record
+        finally:
+            record['seconds'] = time.perf_counter() - startTime
+            stack.pop()
+            with self.lock:
+                self.spans.append(record)
+
+    def round_trips(self, count=1):
+        # Counted on the innermost open span of this thread, serial and laser exchanges alike
+        stack = getattr(self.local, 'stack', None)
+        if stack:
+            stack[-1]['round_trips'] += count
+
+    def start_batch(self):
+        with self.lock:
+            self.spans = []
+        self.batchStart = time.time()
+
+    def finish_batch(self, batchId, cavityRecords):
+        # Folds the batch's spans into the shift aggregates and writes the export files
+        with self.lock:
+            spans, self.spans = self.spans, []
+        shift = results.shift_name(self.batchStart)
+        self.count('batches_total', shift)
+        self.observe('batch_seconds', batchBuckets, time.time() - self.batchStart, shift)
+        for record in cavityRecords.values():
+            if record.get('passed') is not None:
+                self.count('cavities_total', shift, result='passed' if record['passed'] else 'failed')
+        for record in spans:
+            instrument = str(record['tags'].get('instrument', ''))
+            if record['phase'] == 'cavity':
+                self.observe('cavity_seconds', cavityBuckets, record['seconds'], shift)
+            self.observe('phase_seconds', phaseBuckets, record['seconds'], shift, phase=record['phase'], instrument=instrument)
+            if record['round_trips']:
+                self.count('round_trips_total', shift, record['round_trips'], phase=record['phase'], instrument=instrument)
+        try:
+            if self.spansPath is not None:
+                self.write_spans(batchId, shift, spans)
+            if self.metricsPath is not None:
+                self.write_metrics()
+        except OSError as ex:
+            logger.error(f'Error writing batch metrics: {ex}')
+
+    def count(self, metric, shift, value=1, **labels):
+        key = (metric, (('shift', shift),) + tuple(labels.items()))
+        self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, metric, buckets, value, shift, **labels):
+        key = (metric, (('shift', shift),) + tuple(labels.items()))
+        if key not in self.histograms:
+            self.histograms[key] = Histogram(buckets)
+        self.histograms[key].observe(value)
+
+    def write_spans(self, batchId, shift, spans):
+        newFile = not os.path.exists(self.spansPath)
+        with open(self.spansPath, 'a', newline='') as spansFile:
+            writer = csv.writer(spansFile)
+            if newFile:
+                writer.writerow(spanColumns)
+            for record in spans:
+                tags = record['tags']
+                writer.writerow((batchId, shift, record['phase'], tags.get('bank', ''), tags.get('cavity', ''), tags.get('instrument', ''),
+                                 f"{record['started_at']:.3f}", f"{record['seconds']:.6f}", record['round_trips']))
+
+    def write_metrics(self):
+        # Written next to the file and swapped in, a textfile collector never reads half a file
+        lines = []
+        for metric in sorted({key[0] for key in self.counters}):
+            lines.append(f'# TYPE {metricPrefix}_{metric} counter')
+            for (name, labels), value in sorted(self.counters.items()):
+                if name == metric:
+                    lines.append(f'{metricPrefix}_{metric}{format_labels(labels)} {value}')
+        for metric in sorted({key[0] for key in self.histograms}):
+            lines.append(f'# TYPE {metricPrefix}_{metric} histogram')
+            for (name, labels), histogram in sorted(self.histograms.items(), key=lambda item: item[0]):
+                if name != metric:
+                    continue
+                cumulative = 0
+                for bound, count in zip(list(histogram.buckets) + ['+Inf'], histogram.counts):
+                    cumulative += count
+                    lines.append(f'{metricPrefix}_{metric}_bucket{format_labels(labels + (("le", str(bound)),))} {cumulative}')
+                lines.append(f'{metricPrefix}_{metric}_sum{format_labels(labels)} {histogram.sum:.6f}')
+                lines.append(f'{metricPrefix}_{metric}_count{format_labels(labels)} {histogram.count}')
+        tempPath = self.metricsPath + '.tmp'
+        with open(tempPath, 'w') as metricsFile:
+            metricsFile.write('\n'.join(lines) + '\n')
+        os.replace(tempPath, self.metricsPath)
+
+
+def format_labels(labels):
+    return '{' + ','.join(f'{name}="{value}"' for name, value in labels) + '}'